@@ -0,0 +1,274 @@
+from typing import List, Dict, Sequence
+from sim_agent import _item_values, _track_moving_bombs
+from env_related import *
+from pommerman.constants import BOARD_SIZE, NUM_AGENTS
+
+import numpy as np
+
+_bomb_arrays = ['bomb_active', 'bomb_positions', 'bomb_life', 'bomb_blast_strength', 'bomb_bomber', 'bomb_moved',
+                'bomb_moving_direction', 'bomb_direction', 'bomb_lost']
+
+
+class BatchTracker(object):
+    """
+    Track the information of SimAgent for a batch of games with array operations. The information of each game is the
+    same as the one of a SimAgent which observes this game.
+
+    The information is kept in these arrays, where N is the number of games, A is the number of agents indexed by
+    agent ids and C is the capacity of bombs of a game, which grows when it is exceeded:
+
+    * `is_alive` (N, A): Whether an agent is alive, i.e., in `SimAgent._agents`
+    * `positions` (N, A, 2): Positions of agents, which are -1 when an agent cannot be found on the board. At the
+      first step, agents which cannot be found are at the corners where they start.
+    * `ammo`, `blast_strength`, `can_kick` (N, A): Abilities of agents
+    * `bomb_active` (N, C): Whether a slot holds a bomb, i.e., in `SimAgent._bombs`
+    * `bomb_positions` (N, C, 2), `bomb_life`, `bomb_blast_strength`, `bomb_bomber`, `bomb_moved` and
+      `bomb_moving_direction` (N, C): Information of bombs, where the moving direction is the value of an action or 0
+    * `bomb_direction`, `bomb_lost` (N, C): The direction a bomb is moving in at the current step like
+      `_Bomb.moving_direction`, and whether a moving bomb cannot be followed like `_Bomb.is_lost`
+    """
+
+    def __init__(self,
+                 num_games: int,
+                 board_size: int = BOARD_SIZE,
+                 num_agents: int = NUM_AGENTS,
+                 bomb_capacity: int = initial_bomb_capacity):
+        self.num_games = num_games
+        self.board_size = board_size
+        self.num_agents = num_agents
+        self.bomb_capacity = bomb_capacity
+
+        self.is_alive = np.zeros((num_games, num_agents), dtype=bool)
+        self.positions = np.full((num_games, num_agents, 2), -1, dtype=np.int64)
+        self.ammo = np.zeros((num_games, num_agents), dtype=np.int64)
+        self.blast_strength = np.zeros((num_games, num_agents), dtype=np.float64)
+        self.can_kick = np.zeros((num_games, num_agents), dtype=bool)
+
+        self.bomb_active = np.zeros((num_games, bomb_capacity), dtype=bool)
+        self.bomb_positions = np.zeros((num_games, bomb_capacity, 2), dtype=np.int64)
+        self.bomb_life = np.zeros((num_games, bomb_capacity), dtype=np.float64)
+        self.bomb_blast_strength = np.zeros((num_games, bomb_capacity), dtype=np.float64)
+        self.bomb_bomber = np.zeros((num_games, bomb_capacity), dtype=np.int64)
+        self.bomb_moved = np.zeros((num_games, bomb_capacity), dtype=bool)
+        self.bomb_moving_direction = np.zeros((num_games, bomb_capacity), dtype=np.int64)
+        self.bomb_direction = np.zeros((num_games, bomb_capacity), dtype=np.int64)
+        self.bomb_lost = np.zeros((num_games, bomb_capacity), dtype=bool)
+
+        # Item values on the boards at the last update, 0 elsewhere
+        self._item_boards = np.zeros((num_games, board_size, board_size), dtype=np.uint8)
+        self._is_first_update = np.ones(num_games, dtype=bool)
+        self._game_index = np.arange(num_games)[:, None]
+
+    def reset(self, games: Sequence[int] = None) -> None:
+        """
+        Start new games, like SimAgent.reset()
+        :param games: Indices of games to reset. All games are reset if it is None.
+        """
+        if games is None:
+            games = slice(None)
+        self._is_first_update[games] = True
+        self.is_alive[games] = False
+        self.bomb_active[games] = False
+
+    def update(self, boards: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray,
+               alive: np.ndarray) -> None:
+        """
+        Update the information with the observations of the current step, like SimAgent.act()
+        :param boards: Boards of shape (N, board_size, board_size)
+        :param bomb_life: Bomb life planes of the same shape
+        :param bomb_blast_strength: Bomb blast strength planes of the same shape
+        :param alive: A mask of shape (N, A) of agents which are alive in the observations
+        """
+        new_positions = self._locate_agents(boards)
+
+        # Games at their first step are updated as well and then initialized
+        missing_items = self._update_items(boards)
+        exploded_bombs, new_bombs, new_moving_bombs, new_bomb_blast_strength = \
+            self._update_bombs(boards, bomb_life, bomb_blast_strength, new_positions)
+        self._update_agents(alive, new_positions, missing_items, exploded_bombs, new_bombs, new_moving_bombs,
+                            new_bomb_blast_strength)
+
+        first = self._is_first_update
+        if first.any():
+            self._init_games(first, alive, new_positions)
+            first[:] = False
+
+    def update_by_observations(self, observations: List[Dict]) -> None:
+        """
+        Update the information with observations of the current step of each game
+        :param observations: A list of N observations
+        """
+        alive = np.zeros((len(observations), self.num_agents), dtype=bool)
+        for i, obs in enumerate(observations):
+            alive[i, [agent_value_to_id(agent_value) for agent_value in obs[alive_agents_obs]]] = True
+
+        self.update(np.stack([obs[board_obs] for obs in observations]),
+                    np.stack([obs[bomb_life_obs] for obs in observations]),
+                    np.stack([obs[bomb_blast_strength_obs] for obs in observations]),
+                    alive)
+
+    def _init_games(self, games: np.ndarray, alive: np.ndarray, new_positions: np.ndarray) -> None:
+        # All agents are alive at the first step, and the ones which are not seen are at their start corners
+        self.positions[games] = new_positions[games]
+        self.is_alive[games] = alive[games]
+        num_alive = alive.sum(axis=1)
+        for game, agent_id in zip(*np.nonzero(games[:, None] & alive & (new_positions[..., 0] < 0))):
+            self.positions[game, agent_id] = initial_agent_position(agent_id, num_alive[game], self.board_size)
+        self.ammo[games] = initial_ammo
+        self.blast_strength[games] = initial_blast_strength
+        self.can_kick[games] = initial_kick_ability
+
+        self.bomb_active[games] = False
+        self._item_boards[games] = 0
+
+    def _locate_agents(self, boards: np.ndarray) -> np.ndarray:
+        """
+        :return: Positions of agents of shape (N, A, 2), which are -1 when an agent cannot be found
+        """
+        agent_values = agent_id_to_value(np.arange(self.num_agents))
+        matches = boards.reshape(self.num_games, 1, -1) == agent_values[None, :, None]
+        cells = matches.argmax(axis=2)
+
+        positions = np.stack([cells // self.board_size, cells % self.board_size], axis=2)
+        positions[~matches.any(axis=2)] = -1
+        return positions
+
+    def _cells(self, planes: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """Get the cells of planes at positions of shape (N, K, 2), where positions of -1 are read as (0, 0)"""
+        positions = np.maximum(positions, 0)
+        return planes[self._game_index, positions[..., 0], positions[..., 1]]
+
+    def _update_items(self, boards: np.ndarray) -> np.ndarray:
+        """
+        :return: Values of missing items which are present at the last step, 0 elsewhere
+        """
+        item_boards = np.where(np.isin(boards, _item_values), boards, 0).astype(np.uint8)
+        missing_items = np.where(item_boards != self._item_boards, self._item_boards, 0)
+        self._item_boards = item_boards
+        return missing_items
+
+    def _update_bombs(self, boards, bomb_life, bomb_blast_strength, new_positions):
+        """
+        :return: Masks of exploded bombs, new moving bombs (N, C), a mask of agents which newly lay bombs and the
+        blast strength of these bombs (N, A)
+        """
+        active = self.bomb_active
+
+        # Update life of bombs
+        self.bomb_life[active] -= bomb_life_reduction
+
+        # Update the moving state of bombs: a stopped bomb is kicked when another agent stands at its position
+        kicker = self._cells(boards, self.bomb_positions).astype(np.int64) - first_agent_value
+        is_agent = (kicker >= 0) & (kicker < self.num_agents)
+        kicker = np.clip(kicker, 0, self.num_agents - 1)
+        old_kicker_positions = self.positions[self._game_index, kicker]
+        new_moving_bombs = active & ~self.bomb_lost & (self.bomb_direction == 0) & is_agent & \
+            self.is_alive[self._game_index, kicker] & (old_kicker_positions != self.bomb_positions).any(axis=2)
+
+        if new_moving_bombs.any():
+            direction = _moving_directions(old_kicker_positions, new_positions[self._game_index, kicker])
+            first_moves = new_moving_bombs & ~self.bomb_moved
+            self.bomb_moved |= new_moving_bombs
+            self.bomb_moving_direction[first_moves] = direction[first_moves]
+            self.bomb_direction[new_moving_bombs] = direction[new_moving_bombs]
+
+        # Follow moving bombs
+        moving = active & ~self.bomb_lost & (self.bomb_direction != 0)
+        stopped = active & ~self.bomb_lost & (self.bomb_direction == 0)
+        found, exploded_moving = _track_moving_bombs(boards, bomb_life, bomb_blast_strength, moving, stopped,
+                                                     self.bomb_positions, self.bomb_life, self.bomb_blast_strength,
+                                                     self.bomb_direction)
+        self.bomb_lost |= active & (self.bomb_direction != 0) & ~found & ~exploded_moving
+
+        # Get exploded bombs
+        life_on_board = self._cells(bomb_life, self.bomb_positions)
+        exploded_bombs = active & (exploded_moving | np.where(self.bomb_lost,
+                                                              self.bomb_life == end_bomb_life,
+                                                              life_on_board == end_bomb_life))
+
+        # Get new laid bombs, which are not put in the slots of bombs exploded at this step
+        has_position = self.positions[..., 0] >= 0
+        new_bombs = self.is_alive & has_position & \
+            (self._cells(bomb_life, self.positions) == initial_bomb_life)
+        new_bomb_blast_strength = self._cells(bomb_blast_strength, self.positions)
+
+        num_bombs = active.sum(axis=1) + new_bombs.sum(axis=1)
+        if (num_bombs > self.bomb_capacity).any():
+            self._grow(int(num_bombs.max()))
+            active = self.bomb_active
+            exploded_bombs = _pad_slots(exploded_bombs, self.bomb_capacity)
+            new_moving_bombs = _pad_slots(new_moving_bombs, self.bomb_capacity)
+
+        free_slots = ~active & ~exploded_bombs
+        self.bomb_active &= ~exploded_bombs
+        if new_bombs.any():
+            games, bombers = np.nonzero(new_bombs)
+            ranks = (np.cumsum(new_bombs, axis=1) - 1)[games, bombers]
+            slots = np.argsort(~free_slots, axis=1, kind='stable')[games, ranks]
+
+            self.bomb_active[games, slots] = True
+            self.bomb_positions[games, slots] = self.positions[games, bombers]
+            self.bomb_life[games, slots] = initial_bomb_life
+            self.bomb_blast_strength[games, slots] = new_bomb_blast_strength[games, bombers]
+            self.bomb_bomber[games, slots] = bombers
+            self.bomb_moved[games, slots] = False
+            self.bomb_moving_direction[games, slots] = 0
+            self.bomb_direction[games, slots] = 0
+            self.bomb_lost[games, slots] = False
+
+        return exploded_bombs, new_bombs, new_moving_bombs, new_bomb_blast_strength
+
+    def _grow(self, bomb_capacity: int) -> None:
+        """Make room for at least bomb_capacity bombs in each game"""
+        capacity = max(self.bomb_capacity, 1)
+        while capacity < bomb_capacity:
+            capacity *= 2
+        for name in _bomb_arrays:
+            setattr(self, name, _pad_slots(getattr(self, name), capacity))
+        self.bomb_capacity = capacity
+
+    def _update_agents(self, alive, new_positions, missing_items, exploded_bombs, new_bombs, new_moving_bombs,
+                       new_bomb_blast_strength) -> None:
+        # Remove dead agents
+        self.is_alive &= alive
+
+        # Update position
+        self.positions[self.is_alive] = new_positions[self.is_alive]
+
+        # Update ability
+        has_position = self.positions[..., 0] >= 0
+        picked_items = np.where(self.is_alive & has_position, self._cells(missing_items, self.positions), 0)
+        self.ammo += picked_items == add_bomb_value
+        self.blast_strength += picked_items == increase_range_value
+        self.can_kick |= picked_items == enable_kick_value
+
+        self.blast_strength = np.where(new_bombs, np.maximum(self.blast_strength, new_bomb_blast_strength),
+                                       self.blast_strength)
+
+        games, slots = np.nonzero(new_moving_bombs)
+        self.can_kick[games, self.bomb_bomber[games, slots]] = True
+
+        # Update ammo
+        games, slots = np.nonzero(exploded_bombs)
+        bombers = self.bomb_bomber[games, slots]
+        np.add.at(self.ammo, (games, bombers), self.is_alive[games, bombers])
+        self.ammo -= new_bombs & self.is_alive
+
+
+def _pad_slots(array: np.ndarray, capacity: int) -> np.ndarray:
+    """Pad the slots of bombs, i.e., the second dimension of an array, with zeros up to the capacity"""
+    padding = [(0, 0), (0, capacity - array.shape[1])] + [(0, 0)] * (array.ndim - 2)
+    return np.pad(array, padding)
+
+
+def _moving_directions(old_positions: np.ndarray, new_positions: np.ndarray) -> np.ndarray:
+    """Get the values of moving directions like SimAgent._get_moving_direction()"""
+    same_row = new_positions[..., 0] == old_positions[..., 0]
+    same_col = new_positions[..., 1] == old_positions[..., 1]
+    return np.select(
+        [same_row & (new_positions[..., 1] == old_positions[..., 1] + 1),
+         same_row & (new_positions[..., 1] == old_positions[..., 1] - 1),
+         same_col & (new_positions[..., 0] == old_positions[..., 0] + 1)],
+        [action_right.value, action_left.value, action_down.value],
+        action_up.value
+    )
@@ -0,0 +1,311 @@
+from pommerman.agents import SimpleAgent
+from pommerman.constants import Action
+from typing import List, Dict, Callable
+from sim_agent import SimAgent
+from env_related import board_obs, alive_agents_obs
+from fast_forward_model import ForwardStates, default_max_blast_strength
+
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+import random
+import numpy as np
+import pommerman
+import fast_forward_model
+
+# Game configs with their numbers of agents
+_configs = {
+    'PommeFFACompetition-v0': 4,
+    'OneVsOne-v0': 2
+}
+# The number of wood relative to the default of a config
+_densities = {
+    'sparse': 0.5,
+    'default': 1.0,
+    'dense': 1.5
+}
+
+
+class _BenchmarkSimAgent(SimAgent):
+    def _act(self, obs, action_space):
+        if self._create_sim_env:
+            # The simulated environment is only rebuilt when it is accessed
+            self._sim_env
+        return Action.Stop
+
+
+def _record_episodes(config: str, density: float, num_episodes: int, seed: int):
+    """
+    Record the observations of the first agent in games of SimpleAgent
+    :return: A list of observations of each episode and the game type
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+    env = pommerman.make(config, [SimpleAgent() for _ in range(_configs[config])])
+    env.seed(seed)
+    env._num_wood = int(env._num_wood * density)
+    env._num_items = min(env._num_items, env._num_wood)
+
+    episodes = []
+    for _ in range(num_episodes):
+        observations = []
+        state = env.reset()
+        done = False
+        while not done:
+            # The planes are copied, since the environment changes its board in place in the next steps
+            observations.append({key: value.copy() if isinstance(value, np.ndarray) else value
+                                 for key, value in state[0].items()})
+            state, _, done, _ = env.step(env.act(state))
+        episodes.append(observations)
+    game_type = env._game_type
+    env.close()
+
+    return episodes, game_type
+
+
+def _replay(episodes: List[List[Dict]], game_type, create_sim_env: bool) -> np.ndarray:
+    """
+    Replay recorded observations through SimAgent.act()
+    :return: The latency of each step in nanoseconds
+    """
+    agent = _BenchmarkSimAgent(create_sim_env)
+    agent.init_agent(0, game_type)
+
+    latencies = []
+    for observations in episodes:
+        agent.reset()
+        for obs in observations:
+            start = time.perf_counter_ns()
+            agent.act(obs, None)
+            latencies.append(time.perf_counter_ns() - start)
+
+    return np.array(latencies)
+
+
+def _peak_memory(episodes: List[List[Dict]], game_type, create_sim_env: bool) -> int:
+    """
+    :return: The peak of memory in bytes allocated while replaying, which is measured in its own run since tracing
+    slows down allocations
+    """
+    tracemalloc.start()
+    _replay(episodes, game_type, create_sim_env)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def _benchmark_scenario(config: str, density_name: str, create_sim_env: bool, episodes, game_type,
+                        repeat: int) -> Dict:
+    # The fastest run is the least disturbed by the machine
+    latencies = min((_replay(episodes, game_type, create_sim_env) for _ in range(repeat)), key=np.sum)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) / 1e3
+
+    return {
+        'config': config,
+        'num_agents': _configs[config],
+        'density': density_name,
+        'create_sim_env': create_sim_env,
+        'steps': len(latencies),
+        'steps_per_sec': len(latencies) / (latencies.sum() / 1e9),
+        'p50_us': p50,
+        'p90_us': p90,
+        'p99_us': p99,
+        'max_us': latencies.max() / 1e3,
+        'peak_memory_kib': _peak_memory(episodes, game_type, create_sim_env) / 1024
+    }
+
+
+def _scan_agent_positions(observations: List[Dict]) -> None:
+    """Locate agents like SimAgent did before positions were indexed: one full board scan per agent"""
+    for obs in observations:
+        for agent_value in obs[alive_agents_obs]:
+            SimAgent._get_agent_pos(obs[board_obs], agent_value)
+
+
+def _index_agent_positions(observations: List[Dict]) -> None:
+    """Locate agents with one scan per step and look them up in the shared index"""
+    agent = SimAgent()
+    for obs in observations:
+        agent._board = obs[board_obs]
+        agent._locate_agents()
+        for agent_value in obs[alive_agents_obs]:
+            agent._agent_positions.get(agent_value)
+
+
+def _benchmark_micro(name: str, func: Callable[[List[Dict]], None], observations: List[Dict], repeat: int) -> Dict:
+    seconds = min(timeit.repeat(lambda: func(observations), number=1, repeat=repeat))
+    return {'name': name, 'us_per_step': seconds / len(observations) * 1e6}
+
+
+def _benchmark_forward_model(config: str, num_states: int, depth: int, seed: int, repeat: int) -> Dict:
+    """
+    Compare the throughput of stepping environments one by one, like the rollouts of simulated environments, with
+    stepping the same states in a batch by fast_forward_model, where both take the same random actions
+    """
+    rng = np.random.default_rng(seed)
+    num_agents = _configs[config]
+    actions = rng.integers(len(Action), size=(depth, num_states, num_agents))
+
+    envs = []
+    for i in range(num_states):
+        env = pommerman.make(config, [SimpleAgent() for _ in range(num_agents)])
+        env.seed(seed + i)
+        env.reset()
+        envs.append(env)
+    max_blast_strength = envs[0]._agent_view_size or default_max_blast_strength
+    initial_states = [env.get_json_info() for env in envs]
+
+    def step_envs():
+        for env, state in zip(envs, initial_states):
+            env._init_game_state = state
+            env.set_json_info()
+        start = time.perf_counter_ns()
+        for t in range(depth):
+            for env, env_actions in zip(envs, actions[t].tolist()):
+                env.step(env_actions)
+        return time.perf_counter_ns() - start
+
+    def step_forward_states():
+        states = ForwardStates.from_envs(envs)
+        start = time.perf_counter_ns()
+        for t in range(depth):
+            fast_forward_model.step(states, actions[t], max_blast_strength)
+            states.step_count += 1
+        return time.perf_counter_ns() - start
+
+    # Both start from the initial states, which step_envs() loads before stepping
+    env_ns = min(step_envs() for _ in range(repeat))
+    for env, state in zip(envs, initial_states):
+        env._init_game_state = state
+        env.set_json_info()
+    fast_ns = min(step_forward_states() for _ in range(repeat))
+    for env in envs:
+        env.close()
+
+    num_steps = num_states * depth
+    return {
+        'config': config,
+        'num_states': num_states,
+        'depth': depth,
+        'env_steps_per_sec': num_steps / (env_ns / 1e9),
+        'fast_steps_per_sec': num_steps / (fast_ns / 1e9),
+        'speedup': env_ns / fast_ns
+    }
+
+
+def _environment() -> Dict:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def _scenario_key(result: Dict):
+    return result['config'], result['density'], result['create_sim_env']
+
+
+def _print_results(results: List[Dict]) -> None:
+    print('{:<24}{:>8}{:>8}{:>12}{:>10}{:>10}{:>10}{:>12}'.format(
+        'config', 'density', 'sim_env', 'steps/sec', 'p50 us', 'p99 us', 'max us', 'peak KiB'))
+    for result in results:
+        print('{:<24}{:>8}{:>8}{:>12.0f}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.1f}'.format(
+            result['config'], result['density'], str(result['create_sim_env']), result['steps_per_sec'],
+            result['p50_us'], result['p99_us'], result['max_us'], result['peak_memory_kib']))
+
+
+def _compare(results: List[Dict], baseline: Dict, threshold: float) -> bool:
+    """
+    Print the changes of results from a baseline
+    :return: Whether there is any regression beyond the threshold
+    """
+    baseline_results = {_scenario_key(result): result for result in baseline['results']}
+    print('\ncompared with {}'.format(baseline['environment']['commit']))
+
+    has_regression = False
+    for result in results:
+        old = baseline_results.get(_scenario_key(result))
+        if old is None:
+            continue
+
+        throughput = result['steps_per_sec'] / old['steps_per_sec'] - 1
+        p99 = result['p99_us'] / old['p99_us'] - 1
+        is_regression = throughput < -threshold or p99 > threshold
+        has_regression |= is_regression
+        print('{:<24}{:>8}{:>8}  steps/sec {:+7.1%}  p99 {:+7.1%}{}'.format(
+            result['config'], result['density'], str(result['create_sim_env']), throughput, p99,
+            '  REGRESSION' if is_regression else ''))
+
+    return has_regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tracking throughput of SimAgent and the latency of '
+                                                 'rebuilding its simulated environment')
+    parser.add_argument('--episodes', type=int, default=5, help='Number of recorded episodes of each scenario')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of replays of each scenario')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the recorded games')
+    parser.add_argument('--output', help='Save the results as JSON to this path')
+    parser.add_argument('--compare', help='Compare with the results saved by a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change reported as a regression')
+    parser.add_argument('--rollout-states', type=int, default=256,
+                        help='Number of states stepped together by the fast forward model')
+    parser.add_argument('--rollout-depth', type=int, default=20, help='Number of steps of the compared rollouts')
+    args = parser.parse_args()
+
+    results = []
+    micro_results = []
+    for config in _configs:
+        for density_name, density in _densities.items():
+            episodes, game_type = _record_episodes(config, density, args.episodes, args.seed)
+            for create_sim_env in [False, True]:
+                results.append(_benchmark_scenario(config, density_name, create_sim_env, episodes, game_type,
+                                                   args.repeat))
+
+            if config == 'PommeFFACompetition-v0' and density_name == 'default':
+                observations = [obs for observations in episodes for obs in observations]
+                micro_results.append(_benchmark_micro('scan agent positions', _scan_agent_positions, observations,
+                                                      args.repeat))
+                micro_results.append(_benchmark_micro('index agent positions', _index_agent_positions, observations,
+                                                      args.repeat))
+
+    forward_results = [_benchmark_forward_model(config, args.rollout_states, args.rollout_depth, args.seed,
+                                                args.repeat) for config in _configs]
+
+    _print_results(results)
+    for result in micro_results:
+        print('{:<32}{:>10.2f} us/step'.format(result['name'], result['us_per_step']))
+    for result in forward_results:
+        print('{:<24} env.step {:>10.0f} steps/sec  fast_forward_model {:>10.0f} steps/sec  {:>6.1f}x'.format(
+            result['config'], result['env_steps_per_sec'], result['fast_steps_per_sec'], result['speedup']))
+
+    report = {'environment': _environment(), 'results': results, 'micro_results': micro_results,
+              'forward_results': forward_results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if _compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+from typing import List, Dict, Iterator, Type
+from pommerman.agents import BaseAgent, SimpleAgent
+from pommerman.constants import BOARD_SIZE, NUM_AGENTS
+from sim_agent import SimAgent
+from env_related import *
+
+import os
+import glob
+import json
+import random
+import multiprocessing
+import numpy as np
+import pommerman
+
+# Arrays of a dataset with their dtypes and shapes of one step, where -1 is the board size and -2 the number of agents
+_dataset_fields = {
+    # The observation
+    board_obs: (np.uint8, (-1, -1)),
+    bomb_life_obs: (np.uint8, (-1, -1)),
+    bomb_blast_strength_obs: (np.uint8, (-1, -1)),
+    alive_agents_obs: (bool, (-2,)),
+    step_count_obs: (np.int32, ()),
+    agent_id_obs: (np.uint8, ()),
+    ammo_obs: (np.uint8, ()),
+    blast_strength_obs: (np.uint8, ()),
+    can_kick_obs: (bool, ()),
+    # The hidden information simulated by SimAgent, where agents are indexed by ids
+    'agent_is_alive': (bool, (-2,)),
+    'agent_positions': (np.int8, (-2, 2)),
+    'agent_ammo': (np.uint8, (-2,)),
+    'agent_blast_strength': (np.uint8, (-2,)),
+    'agent_can_kick': (bool, (-2,)),
+    # Life and bomber id of the simulated bombs at their positions, where the bomber id is -1 without a bomb. Of
+    # several bombs at a cell, the one of the minimum life is kept (see _encode_bombs())
+    'bomb_life_estimate': (np.uint8, (-1, -1)),
+    'bomb_bomber': (np.int8, (-1, -1))
+}
+
+
+def _encode_bombs(positions: np.ndarray, life: np.ndarray, bomber_ids: np.ndarray,
+                  bomb_life_estimate: np.ndarray, bomb_bomber: np.ndarray) -> None:
+    """
+    Write the life and bomber id of bombs at their cells. When several bombs share a cell (e.g. a kicked bomb stopped
+    on another one), the bomb of the minimum life is kept, with ties broken by the lower bomber id: it explodes
+    first and sets off the others, so it decides when the cell is in flames.
+    :param positions: Positions of the bombs of shape (N, 2)
+    :param life: Life of the bombs of shape (N,)
+    :param bomber_ids: Bomber ids of the bombs of shape (N,)
+    :param bomb_life_estimate: The plane of life to write, which is 0 without a bomb
+    :param bomb_bomber: The plane of bomber ids to write, which is -1 without a bomb
+    """
+    bomb_life_estimate[...] = 0
+    bomb_bomber[...] = -1
+
+    # The first bomb of each cell in the order of life and bomber id
+    order = np.lexsort((bomber_ids, life))
+    cells = positions[order, 0] * bomb_bomber.shape[1] + positions[order, 1]
+    _, first = np.unique(cells, return_index=True)
+    kept = order[first]
+
+    rows, cols = positions[kept, 0], positions[kept, 1]
+    bomb_life_estimate[rows, cols] = life[kept]
+    bomb_bomber[rows, cols] = bomber_ids[kept]
+
+
+class DatasetWriter(object):
+    """
+    Write the observations and the hidden information simulated by SimAgent of steps into shards of preallocated
+    memory-mapped .npy files, which are read by DatasetReader without copying.
+    """
+
+    def __init__(self, directory: str, shard_size: int = 1 << 20, board_size: int = BOARD_SIZE,
+                 num_agents: int = NUM_AGENTS, prefix: str = 'shard'):
+        """
+        :param directory: The directory of the dataset
+        :param shard_size: The number of steps of each shard
+        :param prefix: Prefix of the files, which must be unique for each writer of the same directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.board_size = board_size
+        self.num_agents = num_agents
+        self.prefix = prefix
+
+        self._shards: List[Dict] = []
+        self._arrays: Dict[str, np.ndarray] = None
+        self._num_steps_in_shard = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, obs, sim_agent: SimAgent) -> None:
+        """
+        Write a step
+        :param obs: The observation of the step
+        :param sim_agent: The SimAgent which has acted on the observation
+        """
+        if self._arrays is None or self._num_steps_in_shard == self.shard_size:
+            self._open_shard()
+
+        t = self._num_steps_in_shard
+        arrays = self._arrays
+        arrays[board_obs][t] = obs[board_obs]
+        arrays[bomb_life_obs][t] = obs[bomb_life_obs]
+        arrays[bomb_blast_strength_obs][t] = obs[bomb_blast_strength_obs]
+        arrays[alive_agents_obs][t] = False
+        arrays[alive_agents_obs][t, [agent_value_to_id(agent_value) for agent_value in obs[alive_agents_obs]]] = True
+        arrays[step_count_obs][t] = obs[step_count_obs]
+        arrays[agent_id_obs][t] = sim_agent.agent_id
+        arrays[ammo_obs][t] = obs[ammo_obs]
+        arrays[blast_strength_obs][t] = obs[blast_strength_obs]
+        arrays[can_kick_obs][t] = obs[can_kick_obs]
+
+        agent_store = sim_agent._agent_store
+        arrays['agent_is_alive'][t] = agent_store.is_alive
+        arrays['agent_positions'][t] = agent_store.positions
+        arrays['agent_ammo'][t] = agent_store.ammo
+        arrays['agent_blast_strength'][t] = agent_store.blast_strength
+        arrays['agent_can_kick'][t] = agent_store.can_kick
+
+        bomb_store = sim_agent._bomb_store
+        slots = np.flatnonzero(bomb_store.active)
+        _encode_bombs(bomb_store.positions[slots], bomb_store.life[slots], bomb_store.bomber_ids[slots],
+                      arrays['bomb_life_estimate'][t], arrays['bomb_bomber'][t])
+
+        self._num_steps_in_shard += 1
+
+    def close(self) -> None:
+        """Flush the shards, truncate the last one to its written steps and write the index of the dataset"""
+        self._close_shard()
+        with open(os.path.join(self.directory, '{}_index.json'.format(self.prefix)), 'w') as f:
+            json.dump({'fields': list(_dataset_fields), 'shards': self._shards}, f)
+
+    def _open_shard(self):
+        self._close_shard()
+
+        name = '{}_{:05d}'.format(self.prefix, len(self._shards))
+        self._arrays = {}
+        for field, (dtype, shape) in _dataset_fields.items():
+            shape = tuple(self.board_size if size == -1 else self.num_agents if size == -2 else size for size in shape)
+            self._arrays[field] = np.lib.format.open_memmap(
+                os.path.join(self.directory, '{}_{}.npy'.format(name, field)),
+                mode='w+', dtype=dtype, shape=(self.shard_size,) + shape)
+        self._shards.append({'name': name, 'num_steps': 0})
+        self._num_steps_in_shard = 0
+
+    def _close_shard(self):
+        if self._arrays is None:
+            return
+        for array in self._arrays.values():
+            array.flush()
+        name = self._shards[-1]['name']
+        self._shards[-1]['num_steps'] = self._num_steps_in_shard
+        # The files are unmapped before the rows which are not written are cut off
+        self._arrays = None
+        if self._num_steps_in_shard < self.shard_size:
+            for field in _dataset_fields:
+                _truncate_npy(os.path.join(self.directory, '{}_{}.npy'.format(name, field)), self._num_steps_in_shard)
+
+
+def _truncate_npy(path: str, num_rows: int) -> None:
+    """
+    Keep the first rows of a .npy file in place, where the header is rewritten with the new shape in the same length
+    and the data after the rows is cut off
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        header_start = f.tell()
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        data_start = f.tell()
+
+        shape = (num_rows,) + shape[1:]
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order, 'shape': shape})
+        # The length of the header is kept, so it is padded with spaces like numpy does
+        header_length = data_start - header_start - (2 if version == (1, 0) else 4)
+        f.seek(data_start - header_length)
+        f.write(header.ljust(header_length - 1).encode('latin1') + b'\n')
+        f.truncate(data_start + num_rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+
+class DatasetReader(object):
+    """Read a dataset written by DatasetWriter, whose arrays are memory-mapped views of the files"""
+
+    def __init__(self, directory: str):
+        self.shards: List[Dict[str, np.ndarray]] = []
+        for index_path in sorted(glob.glob(os.path.join(directory, '*_index.json'))):
+            with open(index_path) as f:
+                index = json.load(f)
+            for shard in index['shards']:
+                if shard['num_steps'] == 0:
+                    continue
+                self.shards.append({
+                    field: np.load(os.path.join(directory, '{}_{}.npy'.format(shard['name'], field)),
+                                   mmap_mode='r')[:shard['num_steps']]
+                    for field in index['fields']
+                })
+
+        self._shard_ends = np.cumsum([len(shard[board_obs]) for shard in self.shards])
+
+    def __len__(self):
+        return int(self._shard_ends[-1]) if len(self.shards) != 0 else 0
+
+    def __getitem__(self, index: int) -> Dict[str, np.ndarray]:
+        """
+        :return: The arrays of a step
+        """
+        if index < 0:
+            index += len(self)
+        shard_index = int(np.searchsorted(self._shard_ends, index, side='right'))
+        start = self._shard_ends[shard_index - 1] if shard_index != 0 else 0
+        return {field: array[index - start] for field, array in self.shards[shard_index].items()}
+
+    def batches(self, batch_size: int) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Iterate over contiguous batches of steps, which are views of the files and do not cross shards
+        """
+        for shard in self.shards:
+            num_steps = len(shard[board_obs])
+            for start in range(0, num_steps, batch_size):
+                yield {field: array[start:start + batch_size] for field, array in shard.items()}
+
+
+class _DatasetSimAgent(SimAgent):
+    """A SimAgent which takes the actions of another agent and writes each step into a dataset"""
+
+    def __init__(self, policy: BaseAgent, writer: DatasetWriter):
+        super(_DatasetSimAgent, self).__init__()
+        self._policy = policy
+        self._writer = writer
+
+    def init_agent(self, id_, game_type):
+        super(_DatasetSimAgent, self).init_agent(id_, game_type)
+        self._policy.init_agent(id_, game_type)
+
+    def reset(self, *args, **kwargs):
+        super(_DatasetSimAgent, self).reset(*args, **kwargs)
+        self._policy.reset(*args, **kwargs)
+
+    def _act(self, obs, action_space):
+        self._writer.write(obs, self)
+        return self._policy.act(obs, action_space)
+
+
+def _generate_shards(directory: str, num_games: int, config: str, policy_class: Type[BaseAgent], shard_size: int,
+                     seed: int, prefix: str) -> None:
+    random.seed(seed)
+    np.random.seed(seed)
+
+    with DatasetWriter(directory, shard_size, prefix=prefix) as writer:
+        agent_list = [_DatasetSimAgent(policy_class(), writer) for _ in range(NUM_AGENTS)]
+        env = pommerman.make(config, agent_list)
+        env.seed(seed)
+
+        for _ in range(num_games):
+            state = env.reset()
+            done = False
+            while not done:
+                state, _, done, _ = env.step(env.act(state))
+        env.close()
+
+
+def generate_dataset(directory: str, num_games: int, config: str = 'PommeFFACompetition-v0',
+                     policy_class: Type[BaseAgent] = SimpleAgent, shard_size: int = 1 << 20, seed: int = 0,
+                     num_processes: int = 1) -> None:
+    """
+    Play games where every agent is a SimAgent acting like policy_class, and write the steps of all agents
+    :param directory: The directory of the dataset
+    :param num_games: The number of games
+    :param config: The config of the games
+    :param policy_class: The class of agents deciding actions
+    :param shard_size: The number of steps of each shard
+    :param seed: The seed of the games, where each process uses its own seed derived from it
+    :param num_processes: The number of processes, each of which writes its own shards
+    """
+    games_per_process = [num_games // num_processes + (i < num_games % num_processes) for i in range(num_processes)]
+    tasks = [
+        (directory, games, config, policy_class, shard_size, seed + i, 'worker{:03d}'.format(i))
+        for i, games in enumerate(games_per_process)
+    ]
+    if num_processes == 1:
+        _generate_shards(*tasks[0])
+    else:
+        with multiprocessing.Pool(num_processes) as pool:
+            pool.starmap(_generate_shards, tasks)
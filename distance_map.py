@@ -0,0 +1,121 @@
+from typing import Sequence, Tuple
+from collections import OrderedDict
+from env_related import *
+
+import numpy as np
+
+# The distance to a cell which cannot be reached
+unreachable = np.inf
+
+# Values of cells which agents can walk through: passages, power-ups and agents, since agents move
+_passable_values = np.array([passage_value, add_bomb_value, increase_range_value, enable_kick_value] +
+                            [agent_id_to_value(agent_id) for agent_id in range(4)])
+
+
+def passable_mask(board: np.ndarray) -> np.ndarray:
+    """
+    :return: A mask of cells which agents can walk through. Rigid walls, wood, bombs, flames and fog are blocked.
+    """
+    return np.isin(board, _passable_values)
+
+
+def distance_maps(passable: np.ndarray, sources: Sequence[Tuple[int, int]]) -> np.ndarray:
+    """
+    Get the shortest distances in steps from each source to all cells with a breadth-first search over all sources
+    at once. Blocked cells are `unreachable` except the sources.
+    :param passable: A mask of passable cells
+    :param sources: Positions of the sources
+    :return: An array of float of shape (K, board_size, board_size)
+    """
+    distances = np.full((len(sources),) + passable.shape, unreachable)
+    for i, (row, col) in enumerate(sources):
+        distances[i, row, col] = 0
+    return _relax(distances, passable)
+
+
+def _relax(distances: np.ndarray, passable: np.ndarray) -> np.ndarray:
+    """
+    Relax the distances to passable cells through their neighbors until nothing changes. The distances must be upper
+    bounds of the shortest ones, and they are exact once some of them are exact and the others are unreachable.
+    """
+    while True:
+        new_distances = distances.copy()
+        np.minimum(new_distances[:, 1:], distances[:, :-1] + 1, out=new_distances[:, 1:])
+        np.minimum(new_distances[:, :-1], distances[:, 1:] + 1, out=new_distances[:, :-1])
+        np.minimum(new_distances[:, :, 1:], distances[:, :, :-1] + 1, out=new_distances[:, :, 1:])
+        np.minimum(new_distances[:, :, :-1], distances[:, :, 1:] + 1, out=new_distances[:, :, :-1])
+        new_distances = np.where(passable, new_distances, distances)
+
+        if (new_distances == distances).all():
+            return distances
+        distances = new_distances
+
+
+class DistanceMapCache(object):
+    """
+    Distance maps of the last sources, each with the passable mask it is computed on. A map is reused when its mask is
+    unchanged, and updated incrementally from the old one when only some cells change:
+
+    * Cells which become passable only shorten distances, so the old distances are relaxed further.
+    * When cells become blocked, the distances up to the nearest of these cells are still exact and the farther ones
+      are computed again from them.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        # Keyed by sources, with the hash of the mask, the mask and the distances
+        self._maps = OrderedDict()
+
+    def __len__(self):
+        return len(self._maps)
+
+    def clear(self) -> None:
+        self._maps.clear()
+
+    def get(self, passable: np.ndarray, sources: Sequence[Tuple[int, int]]) -> np.ndarray:
+        """
+        Get the distance maps like distance_maps(), where the maps which are not cached are computed together
+        :param passable: A mask of passable cells, which is kept by the cache and must not be modified
+        :param sources: Positions of the sources
+        :return: An array of float of shape (K, board_size, board_size), which is a copy of the cached maps
+        """
+        passable_hash = hash(passable.tobytes())
+        result = np.empty((len(sources),) + passable.shape)
+
+        # The maps to compute are stacked as upper bounds of their distances
+        updated_indices = []
+        updated_distances = []
+        for i, source in enumerate(sources):
+            source = (int(source[0]), int(source[1]))
+            cached = self._maps.get(source)
+            if cached is not None and cached[0] == passable_hash and np.array_equal(cached[1], passable):
+                self._maps.move_to_end(source)
+                result[i] = cached[2]
+                continue
+
+            if cached is None:
+                distances = np.full(passable.shape, unreachable)
+                distances[source] = 0
+            else:
+                distances = cached[2].copy()
+                new_blocked = cached[1] & ~passable
+                if new_blocked.any():
+                    distances[distances > distances[new_blocked].min()] = unreachable
+                    distances[new_blocked] = unreachable
+                    distances[source] = 0
+
+            updated_indices.append(i)
+            updated_distances.append(distances)
+
+        if len(updated_indices) != 0:
+            updated_distances = _relax(np.stack(updated_distances), passable)
+            result[updated_indices] = updated_distances
+
+            for i, distances in zip(updated_indices, updated_distances):
+                source = (int(sources[i][0]), int(sources[i][1]))
+                self._maps[source] = (passable_hash, passable, distances)
+                self._maps.move_to_end(source)
+            while len(self._maps) > self.capacity:
+                self._maps.popitem(last=False)
+
+        return result
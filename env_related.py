@@ -21,9 +21,14 @@ agent_dummy = Item.AgentDummy
 end_bomb_life = BombLifeType(0)
 initial_bomb_life = DEFAULT_BOMB_LIFE
 initial_blast_strength = DEFAULT_BLAST_STRENGTH
+initial_bomb_capacity = 32
 
 bomb_value = Item.Bomb.value
+wood_value = Item.Wood.value
+rigid_value = Item.Rigid.value
 flame_value = Item.Flames.value
+fog_value = Item.Fog.value
+first_agent_value = Item.Agent0.value
 passage_value = Item.Passage.value
 enable_kick_value = Item.Kick.value
 add_bomb_value = Item.ExtraBomb.value
@@ -31,7 +36,10 @@ increase_range_value = Item.IncrRange.value
 
 ammo_obs = 'ammo'
 board_obs = 'board'
+enemies_obs = 'enemies'
 agent_id_obs = 'agent_id'
+position_obs = 'position'
+teammate_obs = 'teammate'
 can_kick_obs = 'can_kick'
 alive_agents_obs = 'alive'
 bomb_life_obs = 'bomb_life'
@@ -47,3 +55,10 @@ def agent_id_to_value(agent_id):
 
 def agent_value_to_id(agent_value):
     return agent_value - 10
+
+
+def initial_agent_position(agent_id, num_agents, board_size):
+    """The position where an agent starts a game, which is a corner of the board like the boards made by Pommerman"""
+    if num_agents == 2:
+        return [(1, 1), (board_size - 2, board_size - 2)][agent_id]
+    return [(1, 1), (board_size - 2, 1), (board_size - 2, board_size - 2), (1, board_size - 2)][agent_id]
@@ -0,0 +1,262 @@
+from typing import List, Dict, Tuple, Type, Sequence, AsyncIterator, Callable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, Executor
+from pommerman.agents import BaseAgent, SimpleAgent
+from sim_agent import SimAgent
+from profiling import total_phase
+from env_related import *
+
+import os
+import math
+import random
+import asyncio
+import numpy as np
+import pommerman
+
+# Names of the tracked information whose accuracy is evaluated
+tracking_names = ['ammo', 'blast_strength', 'can_kick', 'bomb_life', 'moving_bomb']
+
+
+class GameResult(object):
+    """The result of a game of a SimAgent"""
+
+    def __init__(self, seed: int, reward: int, num_steps: int, num_checks: Dict[str, int],
+                 num_correct: Dict[str, int], latencies: np.ndarray):
+        """
+        :param seed: The seed of the game
+        :param reward: The final reward of the SimAgent
+        :param num_steps: The number of steps
+        :param num_checks: The number of checks of each tracked information
+        :param num_correct: The number of checks where each tracked information is correct
+        :param latencies: The latency of each act() of the SimAgent in nanoseconds
+        """
+        self.seed = seed
+        self.reward = reward
+        self.num_steps = num_steps
+        self.num_checks = num_checks
+        self.num_correct = num_correct
+        self.latencies = latencies
+
+    @property
+    def win(self) -> bool:
+        return self.reward == 1
+
+
+class EvaluationStats(object):
+    """Statistics of the games of a SimAgent which have finished"""
+
+    def __init__(self):
+        self.num_games = 0
+        self.num_wins = 0
+        self.num_checks: Dict[str, int] = Counter()
+        self.num_correct: Dict[str, int] = Counter()
+        self._latencies: List[np.ndarray] = []
+
+    def add(self, result: GameResult) -> None:
+        self.num_games += 1
+        self.num_wins += result.win
+        self.num_checks.update(result.num_checks)
+        self.num_correct.update(result.num_correct)
+        self._latencies.append(result.latencies)
+
+    @property
+    def win_rate(self) -> float:
+        return self.num_wins / self.num_games if self.num_games != 0 else math.nan
+
+    def win_rate_interval(self, z: float = 1.96) -> Tuple[float, float]:
+        return wilson_interval(self.num_wins, self.num_games, z)
+
+    def accuracy(self, name: str) -> float:
+        return self.num_correct[name] / self.num_checks[name] if self.num_checks[name] != 0 else math.nan
+
+    def accuracy_interval(self, name: str, z: float = 1.96) -> Tuple[float, float]:
+        return wilson_interval(self.num_correct[name], self.num_checks[name], z)
+
+    def latency_percentiles(self, percentiles: Sequence[float] = (50, 99)) -> np.ndarray:
+        """
+        :return: Percentiles of the latency of act() in milliseconds
+        """
+        latencies = np.concatenate(self._latencies) if self._latencies else np.zeros(0)
+        if len(latencies) == 0:
+            return np.full(len(percentiles), np.nan)
+        return np.percentile(latencies, percentiles) / 1e6
+
+    def is_precise(self, max_interval_width: float, z: float = 1.96) -> bool:
+        """
+        :return: Whether the confidence intervals of the win rate and of all tracking accuracies are narrow enough
+        """
+        intervals = [self.win_rate_interval(z)] + [self.accuracy_interval(name, z) for name in self.num_checks]
+        return all(high - low <= max_interval_width for low, high in intervals)
+
+    def summary(self) -> str:
+        low, high = self.win_rate_interval()
+        p50, p99 = self.latency_percentiles()
+        lines = ['{} games, win rate {:.3f} [{:.3f}, {:.3f}], act() p50 {:.2f} ms p99 {:.2f} ms'.format(
+            self.num_games, self.win_rate, low, high, p50, p99)]
+        for name in tracking_names:
+            if self.num_checks[name] != 0:
+                lines.append('  {:<16}accuracy {:.4f} in {} checks'.format(name, self.accuracy(name),
+                                                                          self.num_checks[name]))
+        return '\n'.join(lines)
+
+
+def wilson_interval(num_successes: int, num_trials: int, z: float = 1.96) -> Tuple[float, float]:
+    """
+    :return: The Wilson score interval of a binomial proportion, which is (0, 1) without trials
+    """
+    if num_trials == 0:
+        return 0.0, 1.0
+    p = num_successes / num_trials
+    denominator = 1 + z * z / num_trials
+    center = (p + z * z / (2 * num_trials)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / num_trials + z * z / (4 * num_trials * num_trials)) / denominator
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+
+def play_game(agent_class: Type[SimAgent], opponent_classes: Sequence[Type[BaseAgent]], config: str,
+              seed: int) -> GameResult:
+    """
+    Play a game of a SimAgent as the first agent, and check its tracked information against the environment in each
+    step until it dies or the game is over
+    :param agent_class: The class of the SimAgent
+    :param opponent_classes: Classes of the other agents
+    :param config: The config of the game
+    :param seed: The seed of the game
+    :return: The result
+    """
+    sim_agent_index = 0
+    sim_agent = agent_class()
+    profiler = sim_agent.enable_profiling(capacity=1 << 12)
+    env = pommerman.make(config, [sim_agent] + [opponent_class() for opponent_class in opponent_classes])
+
+    random.seed(seed)
+    np.random.seed(seed)
+    env.seed(seed)
+
+    num_checks = Counter()
+    num_correct = Counter()
+
+    def check(name, expected, actual):
+        num_checks[name] += 1
+        num_correct[name] += expected == actual
+
+    state = env.reset()
+    moved_bombs = set()
+    num_steps = 0
+    reward = [0] * len(env._agents)
+    done = False
+    while not done:
+        actions = env.act(state)
+
+        for agent in sim_agent._agents:
+            real_agent = env._agents[agent.id]
+            check('ammo', real_agent.ammo, agent.ammo)
+            check('blast_strength', real_agent.blast_strength, agent.blast_strength)
+            check('can_kick', real_agent.can_kick, agent.can_kick)
+
+        # The life of a bomb is only accurate until it is moved, after which the bomb is followed on the board
+        bomb_life = {bomb.pos: bomb.life for bomb in sim_agent._bombs if not bomb.has_been_moved}
+        moving_bombs = {bomb.pos: (bomb.life, bomb.bomber.id) for bomb in sim_agent._bombs
+                        if bomb.has_been_moved and not bomb.is_lost}
+        for real_bomb in env._bombs:
+            if real_bomb.moving_direction != bomb_stop_value:
+                moved_bombs.add(real_bomb)
+            if real_bomb not in moved_bombs:
+                check('bomb_life', real_bomb.life, bomb_life.get(real_bomb.position))
+            else:
+                check('moving_bomb', (real_bomb.life, real_bomb.bomber.agent_id),
+                      moving_bombs.get(real_bomb.position))
+
+        state, reward, done, info = env.step(actions)
+        num_steps += 1
+        if not env._agents[sim_agent_index].is_alive:
+            done = True
+
+    env.close()
+    sim_agent.shutdown()
+    return GameResult(seed, reward[sim_agent_index], num_steps, dict(num_checks), dict(num_correct),
+                      profiler.samples(total_phase).copy())
+
+
+async def evaluate(agent_class: Type[SimAgent],
+                   opponent_classes: Sequence[Type[BaseAgent]] = (SimpleAgent, SimpleAgent, SimpleAgent),
+                   config: str = 'PommeFFACompetition-v0',
+                   max_games: int = 1000,
+                   min_games: int = 30,
+                   max_interval_width: float = None,
+                   seed: int = 0,
+                   executor: Executor = None,
+                   max_in_flight: int = None) -> AsyncIterator[Tuple[GameResult, EvaluationStats]]:
+    """
+    Play games of a SimAgent in worker processes and stream the result of each game as it finishes, with the
+    statistics of all finished games
+    :param agent_class: The class of the SimAgent, which must be importable by the workers
+    :param opponent_classes: Classes of the other agents
+    :param config: The config of the games
+    :param max_games: The maximum number of games
+    :param min_games: The number of games played before stopping early
+    :param max_interval_width: Stop early once the 95% confidence intervals of the win rate and of the tracking
+    accuracies are not wider than this. Never stop early if it is None.
+    :param seed: The seed of the first game, where the i-th game is seeded by seed + i
+    :param executor: The executor running games, which is shared by concurrent evaluations. A process pool with one
+    process per CPU core is created if it is None.
+    :param max_in_flight: The maximum number of games submitted but not finished
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+    if max_in_flight is None:
+        max_in_flight = 2 * (os.cpu_count() or 1)
+
+    loop = asyncio.get_running_loop()
+    stats = EvaluationStats()
+    pending = set()
+    num_submitted = 0
+    try:
+        while True:
+            while len(pending) < max_in_flight and num_submitted < max_games:
+                pending.add(loop.run_in_executor(executor, play_game, agent_class, tuple(opponent_classes), config,
+                                                 seed + num_submitted))
+                num_submitted += 1
+            if not pending:
+                return
+
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                stats.add(result)
+                yield result, stats
+
+            if max_interval_width is not None and stats.num_games >= min_games and \
+                    stats.is_precise(max_interval_width):
+                return
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+async def evaluate_all(agent_classes: Sequence[Type[SimAgent]],
+                       on_result: Callable[[Type[SimAgent], GameResult, EvaluationStats], None] = None,
+                       max_workers: int = None,
+                       **kwargs) -> Dict[str, EvaluationStats]:
+    """
+    Evaluate SimAgents concurrently with evaluate(), whose games share a process pool
+    :param agent_classes: Classes of the SimAgents
+    :param on_result: Called with the class, the game result and the statistics whenever a game finishes
+    :param max_workers: The number of processes, which is the number of CPU cores if it is None
+    :param kwargs: Other arguments of evaluate()
+    :return: The final statistics of each SimAgent keyed by the names of the classes
+    """
+    all_stats = {}
+
+    async def evaluate_agent(agent_class):
+        async for result, stats in evaluate(agent_class, executor=executor, **kwargs):
+            all_stats[agent_class.__name__] = stats
+            if on_result is not None:
+                on_result(agent_class, result, stats)
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        await asyncio.gather(*(evaluate_agent(agent_class) for agent_class in agent_classes))
+    return all_stats
@@ -0,0 +1,566 @@
+from typing import Dict, Sequence, Tuple
+from functools import lru_cache
+from pommerman.constants import BOARD_SIZE, NUM_AGENTS, MAX_STEPS, GameType
+from env_related import *
+
+import numpy as np
+
+# Abilities are bounded like the bombers of Pommerman, where the environment passes the size of the view of agents
+# (or this default) as the maximum blast strength to its forward model
+max_ammo = 10
+default_max_blast_strength = 10
+
+# The life of flames made by explosions. Flames of life 0 are gone in the next step.
+new_flame_life = 2
+
+# Bomber.maybe_lay_bomb() of Pommerman lays bombs with a life of DEFAULT_BOMB_LIFE + 1, and the forward model ticks
+# them in the same step, which leaves them with the initial life observed by SimAgent
+_laid_bomb_life = initial_bomb_life + bomb_life_reduction
+
+_bomb_action = ActionType.Bomb.value
+
+# Offsets of positions indexed by values of actions, where Stop and Bomb do not move
+_action_offsets = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1], [0, 0]], dtype=np.int64)
+
+# Unit vectors of the four blast directions
+_blast_directions = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+# Values of cells which agents cannot move into, and which bombs cannot move or be kicked into
+_wall_table = np.zeros(256, dtype=bool)
+_wall_table[[rigid_value, wood_value]] = True
+_bomb_block_table = _wall_table.copy()
+_bomb_block_table[[add_bomb_value, increase_range_value, enable_kick_value]] = True
+
+_bomb_arrays = ['bomb_positions', 'bomb_life', 'bomb_blast_strength', 'bomb_bomber_ids', 'bomb_moving_directions']
+_state_arrays = ['step_count', 'board', 'items', 'flames', 'agent_positions', 'agent_ammo', 'agent_blast_strength',
+                 'agent_can_kick', 'agent_is_alive', 'bomb_count'] + _bomb_arrays
+
+
+class ForwardStates(object):
+    """
+    A batch of game states for the forward model, whose attributes are arrays with a leading dimension over states:
+
+    * board: The board, where cells with agents, bombs and flames have their values
+    * items: Values of the items which are revealed when the flames of a cell are gone, 0 elsewhere, like the items
+      of the environment
+    * flames: The lives of the flames of each cell as bits, where bit i is set if a flame of life i is there
+    * agent_*: Attributes of agents indexed by agent ids
+    * bomb_*: Attributes of bombs, where the first bomb_count slots of a state hold its bombs in the order they are
+      laid. A moving direction is the value of an action, which is 0 for bombs which do not move.
+    """
+
+    def __init__(self,
+                 num_states: int,
+                 board_size: int = BOARD_SIZE,
+                 num_agents: int = NUM_AGENTS,
+                 bomb_capacity: int = initial_bomb_capacity):
+        self.step_count = np.zeros(num_states, dtype=np.int64)
+        self.board = np.zeros((num_states, board_size, board_size), dtype=np.uint8)
+        self.items = np.zeros((num_states, board_size, board_size), dtype=np.uint8)
+        self.flames = np.zeros((num_states, board_size, board_size), dtype=np.uint8)
+
+        self.agent_positions = np.zeros((num_states, num_agents, 2), dtype=np.int64)
+        self.agent_ammo = np.zeros((num_states, num_agents), dtype=np.int64)
+        self.agent_blast_strength = np.zeros((num_states, num_agents), dtype=np.int64)
+        self.agent_can_kick = np.zeros((num_states, num_agents), dtype=bool)
+        self.agent_is_alive = np.zeros((num_states, num_agents), dtype=bool)
+
+        self.bomb_count = np.zeros(num_states, dtype=np.int64)
+        self.bomb_positions = np.zeros((num_states, bomb_capacity, 2), dtype=np.int64)
+        self.bomb_life = np.zeros((num_states, bomb_capacity), dtype=np.int64)
+        self.bomb_blast_strength = np.zeros((num_states, bomb_capacity), dtype=np.int64)
+        self.bomb_bomber_ids = np.zeros((num_states, bomb_capacity), dtype=np.int64)
+        self.bomb_moving_directions = np.zeros((num_states, bomb_capacity), dtype=np.int64)
+
+        # Scratch arrays over all cells of all states, which are reused by steps instead of allocated in each of them
+        self._scratch: Dict[str, np.ndarray] = {}
+
+    @property
+    def num_states(self) -> int:
+        return len(self.board)
+
+    @property
+    def board_size(self) -> int:
+        return self.board.shape[1]
+
+    @property
+    def num_agents(self) -> int:
+        return self.agent_is_alive.shape[1]
+
+    @property
+    def bomb_capacity(self) -> int:
+        return self.bomb_life.shape[1]
+
+    @staticmethod
+    def from_sim_states(states: Sequence[Dict], bomb_capacity: int = initial_bomb_capacity) -> 'ForwardStates':
+        """
+        Stack states built by SimAgent._build_sim_state() or sampled by SimAgent._sample_sim_states()
+        :param states: The states, whose bombers are all resolved
+        :param bomb_capacity: The initial number of bomb slots of each state, which grows when it is exceeded
+        :return: The batch of the states
+        """
+        board_size = int(states[0]['board_size'])
+        num_agents = len(states[0]['agents'])
+        bomb_capacity = max([bomb_capacity] + [len(state['bombs']) for state in states])
+        forward_states = ForwardStates(len(states), board_size, num_agents, bomb_capacity)
+
+        for i, state in enumerate(states):
+            forward_states.step_count[i] = state['step_count']
+            forward_states.board[i] = state['board']
+            for position, value in state['items']:
+                forward_states.items[i, position[0], position[1]] = value
+            for flame in state['flames']:
+                row, col = flame['position']
+                forward_states.flames[i, row, col] |= 1 << int(flame['life'])
+
+            for agent in state['agents']:
+                agent_id = agent['agent_id']
+                forward_states.agent_positions[i, agent_id] = agent['position']
+                forward_states.agent_ammo[i, agent_id] = agent['ammo']
+                forward_states.agent_blast_strength[i, agent_id] = agent['blast_strength']
+                forward_states.agent_can_kick[i, agent_id] = agent['can_kick']
+                forward_states.agent_is_alive[i, agent_id] = agent['is_alive']
+
+            forward_states.bomb_count[i] = len(state['bombs'])
+            for slot, bomb in enumerate(state['bombs']):
+                forward_states.bomb_positions[i, slot] = bomb['position']
+                forward_states.bomb_life[i, slot] = bomb['life']
+                forward_states.bomb_blast_strength[i, slot] = bomb['blast_strength']
+                forward_states.bomb_bomber_ids[i, slot] = bomb['bomber_id']
+                forward_states.bomb_moving_directions[i, slot] = bomb['moving_direction'] or action_stop.value
+
+        return forward_states
+
+    @staticmethod
+    def from_envs(envs: Sequence, bomb_capacity: int = initial_bomb_capacity) -> 'ForwardStates':
+        """
+        Stack the states of Pommerman environments, e.g., to validate the forward model against their steps
+        :param envs: The environments
+        :param bomb_capacity: The initial number of bomb slots of each state, which grows when it is exceeded
+        :return: The batch of the states
+        """
+        return ForwardStates.from_sim_states([{
+            'board_size': env._board_size,
+            'step_count': env._step_count,
+            'board': env._board,
+            'items': list(env._items.items()),
+            'flames': [{'position': flame.position, 'life': flame.life} for flame in env._flames],
+            'agents': [{
+                'agent_id': agent.agent_id,
+                'is_alive': agent.is_alive,
+                'position': agent.position,
+                'ammo': agent.ammo,
+                'blast_strength': agent.blast_strength,
+                'can_kick': agent.can_kick
+            } for agent in env._agents],
+            'bombs': [{
+                'position': bomb.position,
+                'life': bomb.life,
+                'blast_strength': bomb.blast_strength,
+                'bomber_id': bomb.bomber.agent_id,
+                'moving_direction': bomb.moving_direction.value if bomb.moving_direction is not None else None
+            } for bomb in env._bombs]
+        } for env in envs], bomb_capacity)
+
+    def repeat(self, repeats: int) -> 'ForwardStates':
+        """
+        :return: A new batch with each state repeated, e.g., the state of the current step for many rollouts
+        """
+        forward_states = ForwardStates(0)
+        for name in _state_arrays:
+            setattr(forward_states, name, np.repeat(getattr(self, name), repeats, axis=0))
+        return forward_states
+
+    def _grow(self, bomb_capacity: int) -> None:
+        """Make room for at least bomb_capacity bombs in each state"""
+        capacity = self.bomb_capacity
+        while capacity < bomb_capacity:
+            capacity *= 2
+        for name in _bomb_arrays:
+            array = getattr(self, name)
+            padding = [(0, 0), (0, capacity - array.shape[1])] + [(0, 0)] * (array.ndim - 2)
+            setattr(self, name, np.pad(array, padding))
+
+    def _scratch_array(self, name: str, size: int, dtype: type, fill_value) -> np.ndarray:
+        """
+        :return: A scratch array filled with the value, which is the same array in each step of this batch
+        """
+        array = self._scratch.get(name)
+        if array is None or len(array) != size:
+            array = self._scratch[name] = np.empty(size, dtype=dtype)
+        array.fill(fill_value)
+        return array
+
+
+def step(states: ForwardStates, actions: np.ndarray, max_blast_strength: int = default_max_blast_strength) -> None:
+    """
+    Step a batch of states in place with the rules of the forward model of Pommerman: flames burn out and reveal
+    items, agents move or lay bombs, moving bombs move, collisions bounce agents and bombs back, agents which can kick
+    kick the bombs they walk into, agents pick up items, bombs tick and explode in chains, and agents in flames die.
+    The step count is not changed, like the forward model.
+    :param states: The states
+    :param actions: Values of the actions of agents of shape (num_states, num_agents), where actions of dead agents
+    are ignored
+    :param max_blast_strength: The maximum blast strength gained by picking up items
+    """
+    actions = np.asarray(actions, dtype=np.int64)
+    num_states = states.num_states
+    board_size = states.board_size
+    num_cells = board_size * board_size
+    num_globals = num_states * num_cells
+    state_indices = np.arange(num_states)[:, None]
+    # Cells of all states are indexed by state index * num_cells + cell index
+    state_offsets = state_indices * num_cells
+    board = states.board.reshape(-1)
+    items = states.items.reshape(-1)
+    flames = states.flames.reshape(-1)
+    neighbor_cells, ray_cells = _board_tables(board_size)
+
+    # Flames burn out, where the first flame of a cell which is gone reveals its item
+    burnt_out = (flames & 1) != 0
+    board[burnt_out] = np.where(items[burnt_out] != 0, items[burnt_out], passage_value)
+    items[burnt_out] = 0
+    flames >>= 1
+    board[flames != 0] = flame_value
+
+    # Agents lay bombs where there is no bomb
+    is_alive = states.agent_is_alive
+    agent_positions = states.agent_positions
+    agent_cells = np.where(is_alive, _cells(agent_positions, board_size), 0)
+    agent_globals = state_offsets + agent_cells
+    # Only the slots up to the largest number of bombs of a state are stepped
+    num_slots = int(states.bomb_count.max())
+    active = np.arange(num_slots) < states.bomb_count[:, None]
+    has_bomb = states._scratch_array('has_bomb', num_globals, bool, False)
+    has_bomb[(state_offsets + _cells(states.bomb_positions[:, :num_slots], board_size))[active]] = True
+    lays = is_alive & (actions == _bomb_action) & (states.agent_ammo > 0) & ~has_bomb[agent_globals]
+    if lays.any():
+        _lay_bombs(states, lays)
+        num_slots = int(states.bomb_count.max())
+        active = np.arange(num_slots) < states.bomb_count[:, None]
+    bomb_positions = states.bomb_positions[:, :num_slots]
+    bomb_life = states.bomb_life[:, :num_slots]
+    bomb_blast_strength = states.bomb_blast_strength[:, :num_slots]
+    bomb_bomber_ids = states.bomb_bomber_ids[:, :num_slots]
+    moving_directions = states.bomb_moving_directions[:, :num_slots]
+    bomb_cells = np.where(active, _cells(bomb_positions, board_size), 0)
+    bomb_globals = state_offsets + bomb_cells
+
+    # Desired positions of agents and moving bombs
+    agent_desired = _desired_cells(board, state_offsets, neighbor_cells, agent_cells, actions, is_alive, _wall_table)
+    board[agent_globals[is_alive]] = passage_value
+    bomb_desired = _desired_cells(board, state_offsets, neighbor_cells, bomb_cells, moving_directions,
+                                  active & (moving_directions != action_stop.value), _bomb_block_table)
+    board[bomb_globals[active]] = passage_value
+
+    # Agents which swap cells bounce back, and so do bombs which cross agents or each other
+    agent_borders = _borders(state_offsets, agent_cells, agent_desired, board_size)
+    agent_moved = agent_desired != agent_cells
+    agent_crossings = states._scratch_array('agent_crossings', 2 * num_globals, np.int64, 0)
+    np.add.at(agent_crossings, agent_borders[agent_moved], 1)
+    agent_desired = np.where(agent_moved & (agent_crossings[agent_borders] > 1), agent_cells, agent_desired)
+    bomb_borders = _borders(state_offsets, bomb_cells, bomb_desired, board_size)
+    bomb_moved = bomb_desired != bomb_cells
+    bomb_crossings = states._scratch_array('bomb_crossings', 2 * num_globals, np.int64, 0)
+    np.add.at(bomb_crossings, bomb_borders[bomb_moved], 1)
+    bomb_desired = np.where(bomb_moved & ((agent_crossings[bomb_borders] > 0) | (bomb_crossings[bomb_borders] > 1)),
+                            bomb_cells, bomb_desired)
+
+    # Agents and bombs which move into the same cell bounce back until nothing changes. Occupancies only grow, so the
+    # result does not depend on the order in which they are checked.
+    agent_occupancy = states._scratch_array('agent_occupancy', num_globals, np.int64, 0)
+    np.add.at(agent_occupancy, (state_offsets + agent_desired)[is_alive], 1)
+    bomb_occupancy = states._scratch_array('bomb_occupancy', num_globals, np.int64, 0)
+    np.add.at(bomb_occupancy, (state_offsets + bomb_desired)[active], 1)
+    while True:
+        targets = state_offsets + agent_desired
+        agent_blocked = (agent_desired != agent_cells) & \
+            ((agent_occupancy[targets] > 1) | (bomb_occupancy[targets] > 1))
+        if agent_blocked.any():
+            agent_desired[agent_blocked] = agent_cells[agent_blocked]
+            np.add.at(agent_occupancy, agent_globals[agent_blocked], 1)
+
+        targets = state_offsets + bomb_desired
+        bomb_blocked = (bomb_desired != bomb_cells) & ((bomb_occupancy[targets] > 1) | (agent_occupancy[targets] > 1))
+        if bomb_blocked.any():
+            bomb_desired[bomb_blocked] = bomb_cells[bomb_blocked]
+            np.add.at(bomb_occupancy, bomb_globals[bomb_blocked], 1)
+
+        if not agent_blocked.any() and not bomb_blocked.any():
+            break
+
+    # Kicks: the agent which moves into the cell of a bomb kicks it one cell further if it can kick and the cell is
+    # free, and otherwise both bounce back
+    agent_at = states._scratch_array('agent_at', num_globals, np.int8, -1)
+    agent_at[(state_offsets + agent_desired)[is_alive]] = np.nonzero(is_alive)[1]
+    kickers = np.where(active, agent_at[state_offsets + bomb_desired], -1)
+    has_kicker = kickers >= 0
+    kickers = np.maximum(kickers, 0)
+    kicker_moved = has_kicker & (agent_desired[state_indices, kickers] != agent_cells[state_indices, kickers])
+    bomb_returns = has_kicker & ~kicker_moved & (bomb_desired != bomb_cells)
+    bounced = kicker_moved & ~states.agent_can_kick[state_indices, kickers]
+    tries_kick = kicker_moved & ~bounced
+
+    kicked = np.zeros(active.shape, dtype=bool)
+    kick_directions = actions[state_indices, kickers]
+    kick_cells = bomb_desired
+    if tries_kick.any():
+        kick_cells = neighbor_cells[bomb_desired, kick_directions]
+        in_board = kick_cells >= 0
+        targets = state_offsets + kick_cells
+        # A kicked bomb frees its cell for its kicker. A bomb kicked into that cell fails anyway since the kicker
+        # moves there, so all kicks are checked at once.
+        kicked = tries_kick & in_board & ~_bomb_block_table[board[targets]] & \
+            (agent_occupancy[targets] == 0) & (bomb_occupancy[targets] == 0)
+        bomb_occupancy[(state_offsets + bomb_desired)[kicked]] = 0
+
+    bomb_returns |= bounced | (tries_kick & ~kicked)
+    agent_returns = np.zeros(is_alive.shape, dtype=bool)
+    agent_returns[state_indices.repeat(active.shape[1], axis=1)[bounced | (tries_kick & ~kicked)],
+                  kickers[bounced | (tries_kick & ~kicked)]] = True
+    bomb_desired = np.where(bomb_returns, bomb_cells, np.where(kicked, kick_cells, bomb_desired))
+    np.add.at(bomb_occupancy, (state_offsets + bomb_desired)[bomb_returns | kicked], 1)
+    agent_desired[agent_returns] = agent_cells[agent_returns]
+    np.add.at(agent_occupancy, agent_globals[agent_returns], 1)
+
+    # Kicks which collide later are undone until nothing changes, in the states with any of the above
+    kicker_of_bomb = np.where(kicked, kickers, -1)
+    bomb_of_kicker = np.full(is_alive.shape, -1)
+    kick_states, kick_slots = np.nonzero(kicked)
+    bomb_of_kicker[kick_states, kickers[kick_states, kick_slots]] = kick_slots
+    resolving = (bomb_returns | kicked).any(axis=1)[:, None]
+    while resolving.any():
+        targets = state_offsets + agent_desired
+        agent_blocked = resolving & (agent_desired != agent_cells) & \
+            ((agent_occupancy[targets] > 1) | (bomb_occupancy[targets] != 0))
+        if agent_blocked.any():
+            undone_states, undone_agents = np.nonzero(agent_blocked & (bomb_of_kicker >= 0))
+            undone_slots = bomb_of_kicker[undone_states, undone_agents]
+            bomb_desired[undone_states, undone_slots] = bomb_cells[undone_states, undone_slots]
+            np.add.at(bomb_occupancy, bomb_globals[undone_states, undone_slots], 1)
+            kicker_of_bomb[undone_states, undone_slots] = -1
+            bomb_of_kicker[undone_states, undone_agents] = -1
+
+            agent_desired[agent_blocked] = agent_cells[agent_blocked]
+            np.add.at(agent_occupancy, agent_globals[agent_blocked], 1)
+
+        targets = state_offsets + bomb_desired
+        bomb_blocked = resolving & ((bomb_desired != bomb_cells) | (kicker_of_bomb >= 0)) & \
+            ((bomb_occupancy[targets] > 1) | (agent_occupancy[targets] != 0))
+        if bomb_blocked.any():
+            undone_states, undone_slots = np.nonzero(bomb_blocked & (kicker_of_bomb >= 0))
+            undone_agents = kicker_of_bomb[undone_states, undone_slots]
+            agent_desired[undone_states, undone_agents] = agent_cells[undone_states, undone_agents]
+            np.add.at(agent_occupancy, agent_globals[undone_states, undone_agents], 1)
+            bomb_of_kicker[undone_states, undone_agents] = -1
+            kicker_of_bomb[undone_states, undone_slots] = -1
+
+            bomb_desired[bomb_blocked] = bomb_cells[bomb_blocked]
+            np.add.at(bomb_occupancy, bomb_globals[bomb_blocked], 1)
+
+        if not agent_blocked.any() and not bomb_blocked.any():
+            break
+
+    # Move bombs, where kicked bombs move in the directions of their kickers and bombs which do not move stop
+    kicked = kicker_of_bomb >= 0
+    moving_directions[active & (bomb_desired == bomb_cells) & ~kicked] = action_stop.value
+    moving_directions[kicked] = kick_directions[kicked]
+    bomb_cells = bomb_desired
+    bomb_globals = state_offsets + bomb_cells
+    bomb_positions[active] = np.stack(np.divmod(bomb_cells[active], board_size), axis=-1)
+
+    # Move agents, which pick up the items of their new cells
+    agent_moved = agent_desired != agent_cells
+    agent_cells = agent_desired
+    agent_globals = state_offsets + agent_cells
+    agent_positions[is_alive] = np.stack(np.divmod(agent_cells[is_alive], board_size), axis=-1)
+    picked_up = np.where(agent_moved, board[agent_globals], passage_value)
+    states.agent_ammo[picked_up == add_bomb_value] += 1
+    np.minimum(states.agent_ammo, max_ammo, out=states.agent_ammo, where=picked_up == add_bomb_value)
+    blast_strength = states.agent_blast_strength
+    blast_strength[picked_up == increase_range_value] += 1
+    np.minimum(blast_strength, max_blast_strength, out=blast_strength, where=picked_up == increase_range_value)
+    states.agent_can_kick[picked_up == enable_kick_value] = True
+
+    # Bombs tick and explode, which sets off the bombs in their flames
+    bomb_life[active] -= bomb_life_reduction
+    exploding = active & ((bomb_life <= end_bomb_life) | (board[bomb_globals] == flame_value))
+    remaining = active & ~exploding
+    exploded_cells = states._scratch_array('exploded_cells', num_globals, bool, False)
+    ammo_returned = np.zeros(is_alive.shape, dtype=np.int64)
+    while exploding.any():
+        exploding_states, exploding_slots = np.nonzero(exploding)
+        np.add.at(ammo_returned, (exploding_states, bomb_bomber_ids[exploding_states, exploding_slots]), 1)
+        _explode(board, exploded_cells, ray_cells, exploding_states * num_cells,
+                 bomb_cells[exploding_states, exploding_slots], bomb_blast_strength[exploding_states, exploding_slots])
+        exploding = remaining & exploded_cells[bomb_globals]
+        remaining &= ~exploding
+    returned = ammo_returned != 0
+    states.agent_ammo[returned] = np.minimum(states.agent_ammo[returned] + ammo_returned[returned], max_ammo)
+
+    # Draw bombs and flames, and agents which are not in flames
+    board[bomb_globals[remaining]] = bomb_value
+    flames[exploded_cells] |= 1 << new_flame_life
+    board[flames != 0] = flame_value
+    is_alive &= board[agent_globals] != flame_value
+    board[agent_globals[is_alive]] = agent_id_to_value(np.nonzero(is_alive)[1])
+
+    # Keep the remaining bombs at the first slots in order
+    if (remaining != active).any():
+        remaining_states, slots = np.nonzero(remaining)
+        new_slots = (np.cumsum(remaining, axis=1) - 1)[remaining_states, slots]
+        for array in [bomb_positions, bomb_life, bomb_blast_strength, bomb_bomber_ids, moving_directions]:
+            array[remaining_states, new_slots] = array[remaining_states, slots]
+        states.bomb_count[:] = remaining.sum(axis=1)
+
+
+def is_done(states: ForwardStates, game_type: GameType, max_steps: int = MAX_STEPS) -> np.ndarray:
+    """
+    :return: Whether each game is over like the environment, which checks it before the step count is increased
+    """
+    is_alive = states.agent_is_alive
+    done = (states.step_count >= max_steps) | (is_alive.sum(axis=1) <= 1)
+    if game_type not in [GameType.FFA, GameType.OneVsOne]:
+        done |= ~is_alive[:, 0::2].any(axis=1) | ~is_alive[:, 1::2].any(axis=1)
+    return done
+
+
+def get_rewards(states: ForwardStates, game_type: GameType, max_steps: int = MAX_STEPS) -> np.ndarray:
+    """
+    :return: Rewards of agents of shape (num_states, num_agents) like the environment
+    """
+    is_alive = states.agent_is_alive
+    num_alive = is_alive.sum(axis=1)[:, None]
+    timeout = (states.step_count >= max_steps)[:, None]
+    if game_type in [GameType.FFA, GameType.OneVsOne]:
+        return np.where(num_alive == 1, 2 * is_alive - 1, np.where(timeout, -1, is_alive - 1))
+
+    # Teams are agents of even ids and agents of odd ids
+    team_alive = np.stack([is_alive[:, 0::2].any(axis=1), is_alive[:, 1::2].any(axis=1)], axis=1)
+    is_winner = team_alive[:, np.arange(states.num_agents) % 2] & ~team_alive[:, 1 - np.arange(states.num_agents) % 2]
+    has_winner = is_winner.any(axis=1)[:, None]
+    return np.where(has_winner, 2 * is_winner - 1, np.where(timeout | (num_alive == 0), -1, 0))
+
+
+def rollout(states: ForwardStates, agent_id: AgentIdType, candidates: Sequence[Sequence[int]], depth: int,
+            game_type: GameType, rng: np.random.Generator, max_blast_strength: int = default_max_blast_strength,
+            max_steps: int = MAX_STEPS) -> np.ndarray:
+    """
+    Run a rollout from each state in place, like RolloutExecutor: the agent takes the actions of its candidate action
+    sequence and then random actions, while all other agents take random actions
+    :param states: The states
+    :param agent_id: Id of the agent
+    :param candidates: A candidate action sequence of each state, whose actions are values of actions
+    :param depth: The number of steps of a rollout
+    :param game_type: The game type, which decides the rewards
+    :param rng: The random generator of the random actions
+    :param max_blast_strength: The maximum blast strength gained by picking up items
+    :param max_steps: The number of steps of a game
+    :return: The value of each rollout, which is the reward of the agent after the depth, or when the agent dies or
+    the game is over
+    """
+    num_states = states.num_states
+    candidate_actions = np.full((num_states, depth), -1, dtype=np.int64)
+    for i, candidate in enumerate(candidates):
+        candidate = list(candidate)[:depth]
+        candidate_actions[i, :len(candidate)] = candidate
+
+    values = np.zeros(num_states, dtype=np.int64)
+    running = np.ones(num_states, dtype=bool)
+    for t in range(depth):
+        actions = rng.integers(len(ActionType), size=(num_states, states.num_agents))
+        actions[:, agent_id] = np.where(candidate_actions[:, t] >= 0, candidate_actions[:, t], actions[:, agent_id])
+        step(states, actions, max_blast_strength)
+
+        values = np.where(running, get_rewards(states, game_type, max_steps)[:, agent_id], values)
+        running &= ~is_done(states, game_type, max_steps) & states.agent_is_alive[:, agent_id]
+        states.step_count += 1
+        if not running.any():
+            break
+    return values
+
+
+def _cells(positions: np.ndarray, board_size: int) -> np.ndarray:
+    return positions[..., 0] * board_size + positions[..., 1]
+
+
+def _desired_cells(board: np.ndarray, state_offsets: np.ndarray, neighbor_cells: np.ndarray, cells: np.ndarray,
+                   directions: np.ndarray, movable: np.ndarray, block_table: np.ndarray) -> np.ndarray:
+    """
+    :return: The cell next to each cell in its direction if it is on the board and not blocked, and the cell itself
+    otherwise
+    """
+    next_cells = neighbor_cells[cells, directions]
+    can_move = movable & (next_cells >= 0) & ~block_table[board[state_offsets + next_cells]]
+    return np.where(can_move, next_cells, cells)
+
+
+def _borders(state_offsets: np.ndarray, cells: np.ndarray, next_cells: np.ndarray, board_size: int) -> np.ndarray:
+    """
+    :return: Indices of the borders between cells and the cells next to them, which are the same for both directions
+    """
+    return (state_offsets + np.minimum(cells, next_cells)) * 2 + (np.abs(next_cells - cells) == board_size)
+
+
+def _lay_bombs(states: ForwardStates, lays: np.ndarray) -> None:
+    """Append the bombs laid by agents to their states in the order of agent ids"""
+    new_counts = states.bomb_count + lays.sum(axis=1)
+    if new_counts.max() > states.bomb_capacity:
+        states._grow(int(new_counts.max()))
+
+    state_indices, agent_ids = np.nonzero(lays)
+    slots = states.bomb_count[state_indices] + (np.cumsum(lays, axis=1) - 1)[state_indices, agent_ids]
+    states.bomb_positions[state_indices, slots] = states.agent_positions[state_indices, agent_ids]
+    states.bomb_life[state_indices, slots] = _laid_bomb_life
+    states.bomb_blast_strength[state_indices, slots] = states.agent_blast_strength[state_indices, agent_ids]
+    states.bomb_bomber_ids[state_indices, slots] = agent_ids
+    states.bomb_moving_directions[state_indices, slots] = action_stop.value
+
+    states.agent_ammo[lays] -= 1
+    states.bomb_count[:] = new_counts
+
+
+def _explode(board: np.ndarray, exploded_cells: np.ndarray, ray_cells: np.ndarray, state_offsets: np.ndarray,
+             cells: np.ndarray, blast_strength: np.ndarray) -> None:
+    """
+    Mark the cells reached by the blasts of bombs like blast_cover() of flame_map.py, for bombs of many states
+    :param board: The flattened boards
+    :param exploded_cells: The flattened mask of exploded cells
+    :param ray_cells: The table of blast rays of _board_tables()
+    :param state_offsets: Offsets of the states of the bombs in the flattened boards
+    :param cells: Cells of the bombs
+    :param blast_strength: Blast strength of the bombs
+    """
+    exploded_cells[state_offsets + cells] = True
+    ranges = blast_strength - 1
+    max_range = min(int(ranges.max()), ray_cells.shape[2])
+    if max_range <= 0:
+        return
+
+    # All cells of all rays are looked up at once. A ray stops before rigid walls and the edge of the board, beyond
+    # its range, and after wood.
+    rays = ray_cells[cells, :, :max_range]
+    ray_globals = state_offsets[:, None, None] + rays
+    values = board[ray_globals]
+    stopped = (rays < 0) | (np.arange(1, max_range + 1) > ranges[:, None, None]) | (values == rigid_value)
+    stopped[..., 1:] |= values[..., :-1] == wood_value
+    reached = ~np.logical_or.accumulate(stopped, axis=2)
+    exploded_cells[ray_globals[reached]] = True
+
+
+@lru_cache(maxsize=None)
+def _board_tables(board_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: The cell next to each cell in the direction of each action of shape (num_cells, num_actions), and the
+    cells of the blast rays from each cell in the four directions of shape (num_cells, 4, board_size - 1), where
+    cells off the board are -1
+    """
+    positions = np.stack(np.divmod(np.arange(board_size * board_size), board_size), axis=-1)
+
+    def cells_at(offsets):
+        target_positions = positions.reshape((-1,) + (1,) * (offsets.ndim - 1) + (2,)) + offsets
+        in_board = ((target_positions >= 0) & (target_positions < board_size)).all(axis=-1)
+        return np.where(in_board, _cells(target_positions, board_size), -1)
+
+    distances = np.arange(1, board_size)
+    return cells_at(_action_offsets), cells_at(_blast_directions[:, None, :] * distances[:, None])
@@ -0,0 +1,84 @@
+from env_related import *
+
+import numpy as np
+
+# The time until flame of a cell which no bomb reaches
+no_flame = np.inf
+
+# Unit vectors of the four blast directions
+_directions = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+
+def blast_cover(board: np.ndarray, bomb_positions: np.ndarray, bomb_blast_strength: np.ndarray) -> np.ndarray:
+    """
+    Get the cells reached by the blast of each bomb, like the explosion of the forward model of Pommerman: a ray
+    reaches blast_strength - 1 cells in each direction besides the bomb, stops before a rigid wall and stops at wood.
+    :param board: The board
+    :param bomb_positions: Positions of bombs of shape (K, 2)
+    :param bomb_blast_strength: Blast strength of bombs of shape (K,)
+    :return: A mask of shape (K, board_size * board_size)
+    """
+    board_size = board.shape[0]
+    num_bombs = len(bomb_positions)
+    cover = np.zeros((num_bombs, board_size * board_size), dtype=bool)
+    if num_bombs == 0:
+        return cover
+
+    bomb_indices = np.arange(num_bombs)
+    cover[bomb_indices, bomb_positions[:, 0] * board_size + bomb_positions[:, 1]] = True
+
+    # All rays of all bombs are cast together, one cell further in each iteration
+    ray_positions = np.repeat(bomb_positions[:, None, :], len(_directions), axis=1)
+    reaching = np.ones((num_bombs, len(_directions)), dtype=bool)
+    ranges = bomb_blast_strength.astype(np.int64) - 1
+    for distance in range(1, int(ranges.max()) + 1):
+        ray_positions = ray_positions + _directions
+        reaching &= (distance <= ranges)[:, None] & \
+            (ray_positions >= 0).all(axis=2) & (ray_positions < board_size).all(axis=2)
+        if not reaching.any():
+            break
+
+        rows = np.where(reaching, ray_positions[..., 0], 0)
+        cols = np.where(reaching, ray_positions[..., 1], 0)
+        cells = board[rows, cols]
+        reaching &= cells != rigid_value
+
+        bombs, directions = np.nonzero(reaching)
+        cover[bombs, rows[bombs, directions] * board_size + cols[bombs, directions]] = True
+        reaching &= cells != wood_value
+
+    return cover
+
+
+def time_until_flame(board: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray) -> np.ndarray:
+    """
+    Get the number of steps after which each cell is in flames, where the explosion of a bomb sets off the bombs in
+    its blast at the same step. Cells in flames now are 0 and cells which no bomb reaches are `no_flame`. Bombs are
+    assumed not to move, and rays stop at the wood of the current board.
+    :param board: The board
+    :param bomb_life: The bomb life plane
+    :param bomb_blast_strength: The bomb blast strength plane
+    :return: An array of float of the shape of the board
+    """
+    board_size = board.shape[0]
+    flame_time = np.full(board.shape, no_flame)
+
+    bomb_positions = np.argwhere(bomb_life > 0)
+    if len(bomb_positions) != 0:
+        rows, cols = bomb_positions[:, 0], bomb_positions[:, 1]
+        cover = blast_cover(board, bomb_positions, bomb_blast_strength[rows, cols])
+
+        # Propagate the earliest explosion time along the bombs reached by each blast until nothing changes
+        explosion_time = bomb_life[rows, cols].astype(np.float64)
+        reaches_bomb = cover[:, rows * board_size + cols]
+        while True:
+            chained_time = np.where(reaches_bomb, explosion_time[:, None], no_flame).min(axis=0)
+            new_explosion_time = np.minimum(explosion_time, chained_time)
+            if (new_explosion_time == explosion_time).all():
+                break
+            explosion_time = new_explosion_time
+
+        flame_time = np.where(cover, explosion_time[:, None], no_flame).min(axis=0).reshape(board.shape)
+
+    flame_time[board == flame_value] = 0
+    return flame_time
@@ -0,0 +1,134 @@
+from typing import Dict, Tuple, Iterable
+from pommerman.constants import NUM_WOOD, NUM_ITEMS
+from env_related import *
+
+import numpy as np
+
+# Hidden extra abilities of an agent: the extra ammo, the extra blast strength and whether kick is gained
+AbilityDeltaType = Tuple[AmmoType, BlastStrengthType, bool]
+
+# Items are hidden under wood with uniformly chosen types
+hidden_item_values = [add_bomb_value, increase_range_value, enable_kick_value]
+_no_delta: AbilityDeltaType = (0, 0, False)
+
+
+class ItemBelief(object):
+    """
+    The belief of items hidden under wood, and of the abilities agents may have gained from them unseen.
+
+    Items are placed under a uniformly chosen subset of the initial wood, so each wood whose content is unknown hides
+    an item with the probability of the remaining items over the remaining wood, which includes the wood hidden in
+    fog. The cells which are known to be unknown are wood, or flames where wood has been destroyed and the item is not
+    revealed yet, and wood first seen after fog joins them. When an agent appears on an unknown cell, it may have
+    picked up the hidden item before anyone sees it, and its hidden extra abilities are kept as a distribution.
+    """
+
+    def __init__(self, num_items: int = NUM_ITEMS, num_wood: int = NUM_WOOD):
+        """
+        :param num_items: The number of items of a game
+        :param num_wood: The number of wood of a game
+        """
+        self.num_items = num_items
+        self.num_wood = num_wood
+
+        # Initialized in reset()
+        self.unknown: np.ndarray = None
+        self.unseen: np.ndarray = None
+        self.probability: np.ndarray = None
+        self.remaining_items: float = None
+        # The number of wood whose content is unknown, including the wood in fog
+        self.remaining_wood: float = None
+
+        # Distributions of hidden extra abilities of agents indexed by agent ids
+        self.ability_deltas: Dict[AgentIdType, Dict[AbilityDeltaType, float]] = {}
+
+    def reset(self, board: np.ndarray) -> None:
+        """
+        Start a game
+        :param board: The board of the first step
+        """
+        self.unknown = board == wood_value
+        self.unseen = board == fog_value
+        self.remaining_items = float(self.num_items)
+        self.remaining_wood = float(max(self.num_wood, self.unknown.sum()))
+        self.ability_deltas.clear()
+        self._update_probability()
+
+    def update(self, board: np.ndarray, new_bombs: Iterable, new_moving_bombs: Iterable) -> None:
+        """
+        Update the belief with the board of the current step
+        :param board: The board
+        :param new_bombs: Bombs newly laid in the current step, which reveal the blast strength of their bombers
+        :param new_moving_bombs: Bombs newly kicked in the current step, which reveal the ability of their kickers
+        """
+        # Wood which is seen for the first time is unknown as well
+        seen = self.unseen & (board != fog_value)
+        if seen.any():
+            self.unknown |= seen & (board == wood_value)
+            self.unseen &= ~seen
+            self._update_probability()
+
+        # Cells stay unknown while they are wood, flames or fog
+        revealed = self.unknown & (board != wood_value) & (board != flame_value) & (board != fog_value)
+        if revealed.any():
+            revealed_values = board[revealed]
+            self.remaining_items -= np.isin(revealed_values, hidden_item_values).sum()
+            self.remaining_wood -= revealed.sum()
+
+            # An agent on a revealed cell may have picked up the item under it
+            probability = self.probability[revealed]
+            for agent_value, p in zip(revealed_values.tolist(), probability.tolist()):
+                if agent_value >= first_agent_value:
+                    self._pick_up(agent_value_to_id(agent_value), p)
+                    self.remaining_items -= p
+
+            self.unknown &= ~revealed
+            self._update_probability()
+
+        # The blast strength of a bomb is the one of its bomber
+        for bomb in new_bombs:
+            self._collapse(bomb.bomber.id, 1)
+        # SimAgent gives the kick ability to the bomber of a kicked bomb
+        for bomb in new_moving_bombs:
+            self._collapse(bomb.bomber.id, 2)
+
+    def ability_distribution(self, agent) -> Dict[Tuple[AmmoType, BlastStrengthType, bool], float]:
+        """
+        :param agent: A simulated agent
+        :return: The distribution of the ammo, blast strength and kick ability of the agent, based on the tracked ones
+        """
+        deltas = self.ability_deltas.get(agent.id, {_no_delta: 1.0})
+        distribution = {}
+        for (ammo, blast_strength, can_kick), p in deltas.items():
+            key = (agent.ammo + ammo, agent.blast_strength + blast_strength, agent.can_kick or can_kick)
+            distribution[key] = distribution.get(key, 0) + p
+        return distribution
+
+    def _update_probability(self):
+        num_wood = max(self.remaining_wood, self.unknown.sum())
+        p = min(max(self.remaining_items, 0) / num_wood, 1) if num_wood != 0 else 0
+        self.probability = self.unknown * p
+
+    def _pick_up(self, agent_id: AgentIdType, p: float):
+        """An agent picks up a hidden item of a uniform type with probability p"""
+        deltas = self.ability_deltas.get(agent_id, {_no_delta: 1.0})
+        new_deltas = {}
+        p_item = p / len(hidden_item_values)
+        for (ammo, blast_strength, can_kick), q in deltas.items():
+            for key, r in [((ammo, blast_strength, can_kick), 1 - p),
+                           ((ammo + 1, blast_strength, can_kick), p_item),
+                           ((ammo, blast_strength + 1, can_kick), p_item),
+                           ((ammo, blast_strength, True), p_item)]:
+                new_deltas[key] = new_deltas.get(key, 0) + q * r
+        self.ability_deltas[agent_id] = new_deltas
+
+    def _collapse(self, agent_id: AgentIdType, index: int):
+        """The ability at an index of the deltas of an agent is observed, so its hidden delta is gone"""
+        deltas = self.ability_deltas.get(agent_id)
+        if deltas is None:
+            return
+        new_deltas = {}
+        for delta, p in deltas.items():
+            delta = delta[:index] + (_no_delta[index],) + delta[index + 1:]
+            new_deltas[delta] = new_deltas.get(delta, 0) + p
+        self.ability_deltas[agent_id] = new_deltas
@@ -0,0 +1,184 @@
+from typing import List, Dict, Tuple, Callable
+from pommerman.constants import BOARD_SIZE, NUM_AGENTS, GameType, Item
+from env_related import *
+
+import numpy as np
+
+# Arrays of a trace with their dtypes and shapes of one step, where -1 is the board size and -2 the number of agents
+_trace_fields = {
+    board_obs: (np.uint8, (-1, -1)),
+    bomb_life_obs: (np.uint8, (-1, -1)),
+    bomb_blast_strength_obs: (np.uint8, (-1, -1)),
+    alive_agents_obs: (bool, (-2,)),
+    step_count_obs: (np.int32, ()),
+    position_obs: (np.uint8, (2,)),
+    ammo_obs: (np.uint8, ()),
+    blast_strength_obs: (np.uint8, ()),
+    can_kick_obs: (bool, ()),
+    teammate_obs: (np.uint8, ()),
+    enemies_obs: (bool, (-2,)),
+    'episode_start': (bool, ()),
+    # The real hidden information of all agents indexed by agent ids, which is only present when it is recorded
+    'true_ammo': (np.uint8, (-2,)),
+    'true_blast_strength': (np.uint8, (-2,)),
+    'true_can_kick': (bool, (-2,)),
+    'has_truth': (bool, ())
+}
+
+
+class _TraceObservation(dict):
+    """An observation of a trace, which tells the keys that are not recorded instead of a bare KeyError"""
+
+    def __missing__(self, key):
+        raise KeyError('{!r} is not recorded in traces, which only have the keys {}'.format(key, sorted(self)))
+
+
+class TraceRecorder(object):
+    """
+    Record the observation of each act() of a SimAgent into fixed-shape arrays, which are saved as a single .npz file.
+    Attach it by SimAgent.set_trace_recorder().
+    """
+
+    def __init__(self, board_size: int = BOARD_SIZE, num_agents: int = NUM_AGENTS, initial_capacity: int = 1024):
+        self.board_size = board_size
+        self.num_agents = num_agents
+        self.num_steps = 0
+        self._is_episode_start = True
+        self._arrays = {
+            name: np.zeros((initial_capacity,) + self._step_shape(shape), dtype=dtype)
+            for name, (dtype, shape) in _trace_fields.items()
+        }
+
+    def __len__(self):
+        return self.num_steps
+
+    def new_episode(self) -> None:
+        """Mark the next recorded step as the start of an episode"""
+        self._is_episode_start = True
+
+    def record(self, obs) -> None:
+        if self.num_steps == len(self._arrays[board_obs]):
+            self._grow()
+
+        t = self.num_steps
+        arrays = self._arrays
+        arrays[board_obs][t] = obs[board_obs]
+        arrays[bomb_life_obs][t] = obs[bomb_life_obs]
+        arrays[bomb_blast_strength_obs][t] = obs[bomb_blast_strength_obs]
+        arrays[alive_agents_obs][t] = False
+        arrays[alive_agents_obs][t, [agent_value_to_id(agent_value) for agent_value in obs[alive_agents_obs]]] = True
+        arrays[step_count_obs][t] = obs[step_count_obs]
+        arrays[position_obs][t] = obs[position_obs]
+        arrays[ammo_obs][t] = obs[ammo_obs]
+        arrays[blast_strength_obs][t] = obs[blast_strength_obs]
+        arrays[can_kick_obs][t] = obs[can_kick_obs]
+        arrays[teammate_obs][t] = obs[teammate_obs].value
+        arrays[enemies_obs][t] = False
+        arrays[enemies_obs][t, [agent_value_to_id(enemy.value) for enemy in obs[enemies_obs]]] = True
+        arrays['episode_start'][t] = self._is_episode_start
+        arrays['has_truth'][t] = False
+
+        self._is_episode_start = False
+        self.num_steps += 1
+
+    def record_truth(self, env) -> None:
+        """
+        Record the real hidden information of agents for the last recorded step
+        :param env: The environment of the game, before it is stepped
+        """
+        t = self.num_steps - 1
+        for agent in env._agents:
+            self._arrays['true_ammo'][t, agent.agent_id] = agent.ammo
+            self._arrays['true_blast_strength'][t, agent.agent_id] = agent.blast_strength
+            self._arrays['true_can_kick'][t, agent.agent_id] = agent.can_kick
+        self._arrays['has_truth'][t] = True
+
+    def save(self, path: str, agent_id: AgentIdType, game_type: GameType) -> None:
+        """
+        Save the recorded steps
+        :param path: Path of the .npz file
+        :param agent_id: Id of the recording agent
+        :param game_type: Game type of the recorded games
+        """
+        np.savez(path, agent_id=agent_id, game_type=game_type.value,
+                 **{name: array[:self.num_steps] for name, array in self._arrays.items()})
+
+    def _step_shape(self, shape: Tuple[int, ...]) -> Tuple[int, ...]:
+        return tuple(self.board_size if size == -1 else self.num_agents if size == -2 else size for size in shape)
+
+    def _grow(self):
+        for name, array in self._arrays.items():
+            self._arrays[name] = np.concatenate([array, np.zeros_like(array)])
+
+
+class Trace(object):
+    """Observations recorded by TraceRecorder"""
+
+    def __init__(self, path: str):
+        with np.load(path) as data:
+            self.agent_id: AgentIdType = int(data['agent_id'])
+            self.game_type = GameType(int(data['game_type']))
+            self.arrays: Dict[str, np.ndarray] = {name: data[name] for name in _trace_fields}
+
+    def __len__(self):
+        return len(self.arrays[board_obs])
+
+    def observation(self, t: int) -> Dict:
+        """
+        :return: The observation of step t with the keys used by SimAgent and the position, teammate and enemies of
+            the agent, where the other keys of Pommerman (e.g. flame_life and message) raise a KeyError telling that
+            they are not recorded
+        """
+        arrays = self.arrays
+        return _TraceObservation({
+            board_obs: arrays[board_obs][t],
+            bomb_life_obs: arrays[bomb_life_obs][t].astype(np.float64),
+            bomb_blast_strength_obs: arrays[bomb_blast_strength_obs][t].astype(np.float64),
+            alive_agents_obs: agent_id_to_value(np.flatnonzero(arrays[alive_agents_obs][t])).tolist(),
+            step_count_obs: int(arrays[step_count_obs][t]),
+            position_obs: tuple(arrays[position_obs][t].tolist()),
+            ammo_obs: int(arrays[ammo_obs][t]),
+            blast_strength_obs: int(arrays[blast_strength_obs][t]),
+            can_kick_obs: bool(arrays[can_kick_obs][t]),
+            teammate_obs: Item(int(arrays[teammate_obs][t])),
+            enemies_obs: [Item(agent_id_to_value(agent_id)) for agent_id in np.flatnonzero(arrays[enemies_obs][t])]
+        })
+
+
+def replay_trace(trace: Trace, agent, on_step: Callable[[int, object], None] = None) -> None:
+    """
+    Feed a SimAgent with the observations of a trace
+    :param trace: The trace
+    :param agent: A SimAgent, which is initialized as the recording agent
+    :param on_step: Called with the step and the agent after each act()
+    """
+    agent.init_agent(trace.agent_id, trace.game_type)
+    episode_starts = trace.arrays['episode_start']
+    for t in range(len(trace)):
+        if episode_starts[t]:
+            agent.reset()
+        agent.act(trace.observation(t), None)
+        if on_step is not None:
+            on_step(t, agent)
+
+
+def find_tracking_errors(trace: Trace, agent) -> List[Tuple[int, AgentIdType, str, object, object]]:
+    """
+    Replay a trace with recorded real hidden information and find where the simulated information of agents is wrong
+    :return: A list of the step, the agent id, the name, the simulated and the real value of each error
+    """
+    errors = []
+    arrays = trace.arrays
+
+    def check(t, _agent):
+        if not arrays['has_truth'][t]:
+            return
+        for simulated in _agent._agents:
+            for name, value in [('ammo', simulated.ammo), ('blast_strength', simulated.blast_strength),
+                                ('can_kick', simulated.can_kick)]:
+                real = arrays['true_' + name][t, simulated.id].item()
+                if value != real:
+                    errors.append((t, simulated.id, name, value, real))
+
+    replay_trace(trace, agent, check)
+    return errors
@@ -0,0 +1,91 @@
+from typing import Sequence, Dict, Callable
+
+import numpy as np
+
+ExportCallback = Callable[[str, np.ndarray], None]
+
+# Phases of SimAgent.act() recorded by PhaseProfiler
+init_phase = 'init'
+init_obs_phase = 'init_obs'
+update_items_phase = 'update_items'
+update_bombs_phase = 'update_bombs'
+update_agents_phase = 'update_agents'
+flame_time_phase = 'flame_time'
+follow_team_phase = 'follow_team'
+update_sim_env_phase = 'update_sim_env'
+act_phase = '_act'
+total_phase = 'total'
+sim_agent_phases = [init_obs_phase, init_phase, update_items_phase, update_bombs_phase, update_agents_phase,
+                    follow_team_phase, flame_time_phase, update_sim_env_phase, act_phase, total_phase]
+
+
+class PhaseProfiler(object):
+    """
+    Record the wall time of phases in nanoseconds into fixed-size ring buffers, one for each phase. When a buffer is
+    full, its samples are passed to the export callback before they are overwritten.
+    """
+
+    def __init__(self, phases: Sequence[str], capacity: int = 4096, export_callback: ExportCallback = None):
+        self.phases = list(phases)
+        self.capacity = capacity
+        self._export_callback = export_callback
+
+        self._phase_index = {phase: i for i, phase in enumerate(self.phases)}
+        self._samples = np.zeros((len(self.phases), capacity), dtype=np.int64)
+        self._counts = [0] * len(self.phases)
+
+    def record(self, phase: str, ns: int) -> None:
+        i = self._phase_index[phase]
+        count = self._counts[i]
+        self._samples[i, count % self.capacity] = ns
+        self._counts[i] = count + 1
+
+        if self._export_callback is not None and (count + 1) % self.capacity == 0:
+            self._export_callback(phase, self._samples[i].copy())
+
+    def samples(self, phase: str) -> np.ndarray:
+        """
+        :return: The samples of a phase in the ring buffer, which are the last ones up to the capacity
+        """
+        i = self._phase_index[phase]
+        return self._samples[i, :min(self._counts[i], self.capacity)]
+
+    def count(self, phase: str) -> int:
+        """
+        :return: The number of samples of a phase ever recorded
+        """
+        return self._counts[self._phase_index[phase]]
+
+    def percentiles(self, phase: str, percentiles: Sequence[float] = (50, 99)) -> np.ndarray:
+        """
+        :return: Percentiles of the samples of a phase in nanoseconds, which are NaN if there is no sample
+        """
+        samples = self.samples(phase)
+        if len(samples) == 0:
+            return np.full(len(percentiles), np.nan)
+        return np.percentile(samples, percentiles)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: The number of samples and p50, p99 and max of the samples in milliseconds of each recorded phase
+        """
+        summary = {}
+        for phase in self.phases:
+            samples = self.samples(phase)
+            if len(samples) == 0:
+                continue
+            p50, p99 = np.percentile(samples, [50, 99]) / 1e6
+            summary[phase] = {'count': self.count(phase), 'p50': p50, 'p99': p99, 'max': samples.max() / 1e6}
+        return summary
+
+    def export(self) -> None:
+        """Pass the samples in the ring buffers of all phases to the export callback"""
+        if self._export_callback is None:
+            return
+        for phase in self.phases:
+            samples = self.samples(phase)
+            if len(samples) != 0:
+                self._export_callback(phase, samples.copy())
+
+    def clear(self) -> None:
+        self._counts = [0] * len(self.phases)
@@ -0,0 +1,164 @@
+from typing import List, Dict, Sequence, Tuple, Optional
+from pommerman.constants import GameType
+from sim_agent import _DummyAgent, _load_sim_state, _make_sim_env
+from env_related import *
+
+import os
+import time
+import multiprocessing
+import numpy as np
+
+# The extra time to wait for the results of workers after the deadline, since they stop at the deadline themselves
+_result_grace_seconds = 0.005
+
+# Initialized in _init_rollout_worker() of each process
+_worker_env = None
+
+
+class RolloutResult(object):
+    """Values of candidate action sequences estimated by the rollouts which are finished before the deadline"""
+
+    def __init__(self, num_candidates: int):
+        self.value_sums = np.zeros(num_candidates)
+        self.counts = np.zeros(num_candidates, dtype=np.int64)
+        # The number of rollouts which raised an error, which are unfinished like the ones after the deadline
+        self.num_errors = 0
+
+    @property
+    def values(self) -> np.ndarray:
+        """
+        :return: The mean value of the rollouts of each candidate, which is NaN if none of them is finished
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.value_sums / self.counts
+
+    def add(self, candidate_indices: Sequence[int], values: Sequence[float]) -> None:
+        np.add.at(self.value_sums, candidate_indices, values)
+        np.add.at(self.counts, candidate_indices, 1)
+
+
+class RolloutExecutor(object):
+    """
+    A pool of worker processes, each of which holds a simulated environment made once. The state of a step is shipped
+    to each worker once with its share of the rollouts.
+
+    A rollout loads the state, takes the actions of a candidate action sequence for the agent and then random actions,
+    while all other agents take random actions. Its value is the reward of the agent after the given depth, or when
+    the agent dies or the game is over.
+    """
+
+    def __init__(self, game_type: GameType, num_agents: int, num_workers: int = None):
+        """
+        :param game_type: The game type of the simulated environments
+        :param num_agents: The number of agents of the simulated environments
+        :param num_workers: The number of worker processes, which is the number of CPU cores if it is None
+        """
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self._pool = multiprocessing.Pool(self.num_workers, _init_rollout_worker, (game_type.value, num_agents))
+        self._seed_sequence = np.random.SeedSequence()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def run(self,
+            state: Dict,
+            agent_id: AgentIdType,
+            candidates: Sequence[Sequence[int]],
+            num_rollouts: int,
+            depth: int,
+            time_limit: float) -> RolloutResult:
+        """
+        Run rollouts from a state under a deadline
+        :param state: A state built by SimAgent._build_sim_state()
+        :param agent_id: Id of the agent whose candidate action sequences are estimated
+        :param candidates: Candidate action sequences, whose actions are values of actions
+        :param num_rollouts: The number of rollouts, which are spread over the candidates evenly
+        :param depth: The number of steps of a rollout
+        :param time_limit: Seconds from now, after which unfinished rollouts are dropped
+        :return: The result of the finished rollouts
+        """
+        deadline = time.time() + time_limit
+        candidates = [list(candidate) for candidate in candidates]
+        candidate_indices = np.arange(num_rollouts) % len(candidates)
+        seeds = self._seed_sequence.spawn(self.num_workers)
+
+        tasks = [
+            self._pool.apply_async(_run_rollouts, (state, agent_id, candidates, candidate_indices[i::self.num_workers],
+                                                   depth, deadline, seeds[i]))
+            for i in range(self.num_workers)
+        ]
+
+        result = RolloutResult(len(candidates))
+        for task in tasks:
+            try:
+                finished_indices, values, num_errors = task.get(
+                    timeout=max(deadline - time.time(), 0) + _result_grace_seconds)
+            except multiprocessing.TimeoutError:
+                continue
+            result.add(finished_indices, values)
+            result.num_errors += num_errors
+        return result
+
+    def close(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _init_rollout_worker(game_type_value: int, num_agents: int) -> None:
+    """Create the simulated environment reused by all rollouts of a worker"""
+    global _worker_env
+
+    _worker_env = _make_sim_env(GameType(game_type_value), [_DummyAgent() for _ in range(num_agents)])
+
+
+def _run_rollouts(state: Dict, agent_id: AgentIdType, candidates: List[List[int]], candidate_indices: np.ndarray,
+                  depth: int, deadline: float, seed) -> Tuple[List[int], List[float], int]:
+    """
+    :return: Indices of the candidates and the values of the rollouts finished before the deadline, and the number of
+    rollouts which raised an error, e.g., on a state which the environment cannot load
+    """
+    rng = np.random.default_rng(seed)
+
+    finished_indices = []
+    values = []
+    num_errors = 0
+    for candidate_index in candidate_indices.tolist():
+        try:
+            value = _rollout(state, agent_id, candidates[candidate_index], depth, deadline, rng)
+        except Exception:
+            # The other rollouts of the worker still run, since the state is loaded again by each of them
+            num_errors += 1
+            continue
+        if value is None:
+            break
+        finished_indices.append(candidate_index)
+        values.append(value)
+
+    return finished_indices, values, num_errors
+
+
+def _rollout(state: Dict, agent_id: AgentIdType, candidate: List[int], depth: int, deadline: float,
+             rng: np.random.Generator) -> Optional[float]:
+    """
+    :return: The value of a rollout, or None if it is not finished before the deadline
+    """
+    env = _worker_env
+    _load_sim_state(env, state)
+
+    value = 0
+    actions = rng.integers(len(ActionType), size=(depth, len(env._agents))).tolist()
+    for step in range(depth):
+        if time.time() > deadline:
+            return None
+        if step < len(candidate):
+            actions[step][agent_id] = candidate[step]
+
+        _, rewards, done, _ = env.step(actions[step])
+        value = rewards[agent_id]
+        if done or not env._agents[agent_id].is_alive:
+            break
+
+    return value
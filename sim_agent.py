@@ -1,31 +1,90 @@
 from __future__ import annotations
-from typing import Dict, Tuple, List, NewType
-from ast import literal_eval
+from typing import Dict, Tuple, List, NewType, TYPE_CHECKING
 from env_related import *
 from enum import Enum
-
+from pommerman import characters
+from pommerman.constants import NUM_AGENTS
+from profiling import PhaseProfiler, ExportCallback, sim_agent_phases, init_phase, init_obs_phase, \
+    update_items_phase, update_bombs_phase, update_agents_phase, follow_team_phase, flame_time_phase, \
+    update_sim_env_phase, act_phase, total_phase
+from item_belief import ItemBelief, hidden_item_values
+
+# The optional parts are imported where they are first used, so agents which do not use them do not load them
+if TYPE_CHECKING:
+    from team_state import TeamState
+    from distance_map import DistanceMapCache
+    from fast_forward_model import ForwardStates
+
+import numpy as np
 import pommerman
 import random
 import json
+import time
 
 
 class SimAgent(pommerman.agents.BaseAgent):
-    def __init__(self, create_sim_env: bool = False):
+    def __init__(self, create_sim_env: bool = False, share_sim_env: bool = False, team_state: TeamState = None):
+        """
+        :param create_sim_env: Whether _sim_env is synchronized with each step
+        :param share_sim_env: Whether _sim_env is shared with the other SimAgents of the same game type in the process,
+        which only suits agents that load a state into it before each use, since the others overwrite it
+        :param team_state: The tracking state shared with the teammate in team games, which is given to both
+        teammates. Each agent tracks on its own if it is None.
+        """
         super(SimAgent, self).__init__()
 
-        self._items: List[_Item] = []
+        self._items: Dict[_Pos, _Item] = {}
         self._agents: List[_Agent] = []
         self._dead_agents: List[_Agent] = []
         self._bombs: List[_Bomb] = []
         self._id_to_agent: Dict[AgentIdType, _Agent] = {}
+        self._agent_positions: Dict[AgentValueType, _Pos] = {}
+
+        # Arrays behind _Agent and _Bomb, which are kept in the team state if there is one
+        self._team_state = team_state
+        if team_state is None:
+            self._agent_store = _AgentStore(NUM_AGENTS)
+            self._bomb_store = _BombStore(initial_bomb_capacity, self._id_to_agent)
+        else:
+            self._agent_store = _AgentStore(team_state.num_agents, team_state.agent_store_arrays())
+            self._bomb_store = _BombStore(team_state.bomb_capacity, self._id_to_agent, team_state.bomb_store_arrays())
+
+        # The index of this agent in the team state, set in init_agent()
+        self._team_member: int = None
+        # Whether the teammate has tracked the current step, so this agent takes its result, set in act()
+        self._follows_team: bool = False
 
         self._is_first_action: bool = True
         self._create_sim_env: bool = create_sim_env
 
-        # Initialized in init_agent()
-        self._sim_env = None
+        # Made or taken from the shared environments on the first access of _sim_env
+        self._sim_env_instance = None
+        self._share_sim_env: bool = share_sim_env
+        # Identifies this agent as the owner of the state of a shared environment
+        self._sim_env_token = object()
+
+        # Set in act() and consumed by the first access of _sim_env in the same step
+        self._sim_env_obs = None
+        # The observation of the current step, with which a shared environment used by another agent is synchronized
+        self._sim_env_step_obs = None
+
+        # Set by enable_profiling()
+        self._profiler: PhaseProfiler = None
+        # The end of the last phase of act() in nanoseconds
+        self._phase_start: int = None
+
+        # Set by set_trace_recorder()
+        self._trace_recorder = None
+
+        # Created on the first access of _rollout_executor
+        self._rollout_executor_instance = None
+        self._game_type = None
+
+        # Preallocated planes which observations are copied into, made on the first act()
+        self._plane_buffers: _PlaneBuffers = None
 
-        # Initialized in act()
+        # Initialized in act(). The planes are read-only views of _plane_buffers, which are overwritten two steps
+        # later, so copy them to keep them longer.
         self._last_board = None
         self._board = None
         self._bomb_life = None
@@ -33,46 +92,141 @@ class SimAgent(pommerman.agents.BaseAgent):
         self._alive_agents = None
         self._step_count = None
 
+        # Item values on the board at the last call of _update_items(), 0 elsewhere, and the buffer of the next call
+        self._item_board = None
+        self._next_item_board = None
+
+        # The belief of items hidden under wood and of abilities gained from them unseen
+        self._item_belief = ItemBelief()
+
+        # The observation of the current step, set in act()
+        self._obs = None
+
+        # The number of steps after which each cell is in flames, computed on the first access of _flame_time
+        self._flame_time_instance: np.ndarray = None
+
+        # The Zobrist hash of the state loaded into the simulated environment at the current step, computed on the
+        # first access of _state_hash. The hash of the planes is updated incrementally with the cells which change
+        # when it was computed at the last step, whose planes are still in _plane_buffers.
+        self._state_hash_instance: int = None
+        self._planes_hash: int = None
+        self._hashed_planes: Tuple[np.ndarray, np.ndarray, np.ndarray] = None
+        self._hashed_step: int = None
+
+        # Distance maps of the current step, computed on the first access of _distance_maps, and the cache of the
+        # maps of the last steps, made on the first access
+        self._distance_maps_instance: np.ndarray = None
+        self._distance_map_cache: DistanceMapCache = None
+
     def act(self, obs, action_space):
+        # The wall time of each phase is recorded when profiling is enabled
+        start = self._phase_start = time.perf_counter_ns()
+
         # Before taking an action
         self._init_obs(obs)
+        self._end_phase(init_obs_phase)
 
-        if self._is_first_action:
+        if self._follows_team:
+            self._follow_team()
+            self._end_phase(follow_team_phase)
+        elif self._is_first_action:
             self._is_first_action = False
+            self._init_items()
             self._init_agents()
+            self._publish_team_tracking([], [])
+            self._end_phase(init_phase)
         else:
             missing_items = self._update_items()
+            self._end_phase(update_items_phase)
             exploded_bombs, new_bombs, new_moving_bombs = self._update_bombs()
+            self._end_phase(update_bombs_phase)
             self._update_agents(missing_items, exploded_bombs, new_bombs, new_moving_bombs)
+            self._publish_team_tracking(new_bombs, new_moving_bombs)
+            self._end_phase(update_agents_phase)
+
+        self._obs = obs
+        # Computed on their first access in this step
+        self._flame_time_instance = None
+        self._distance_maps_instance = None
+        self._state_hash_instance = None
 
         if self._create_sim_env:
-            # Update the simulated environment
-            self._update_sim_env(obs)
+            # The simulated environment is updated on its first access in this step
+            self._sim_env_obs = obs
+            self._sim_env_step_obs = obs
 
-        # Take an action
+        # Take an action, where the flame map and the rebuild of the simulated environment are recorded in their own
+        # phases as well
         action = self._act(obs, action_space)
+        self._end_phase(act_phase)
 
         # After taking an action
-        self._last_board = self._board.copy()
+        self._last_board = self._board
 
+        if self._profiler is not None:
+            self._profiler.record(total_phase, time.perf_counter_ns() - start)
         return action
 
+    def _end_phase(self, phase: str) -> None:
+        """Record the wall time since the end of the last phase of act() if profiling is enabled"""
+        if self._profiler is not None:
+            now = time.perf_counter_ns()
+            self._profiler.record(phase, now - self._phase_start)
+            self._phase_start = now
+
+    def enable_profiling(self, capacity: int = 4096, export_callback: ExportCallback = None) -> PhaseProfiler:
+        """
+        Record the wall time of each phase of act() from now on
+        :param capacity: The number of the last samples kept for each phase
+        :param export_callback: Called with a phase and its samples in nanoseconds whenever its buffer is full
+        :return: The profiler, whose summary() gives the percentiles of each phase
+        """
+        self._profiler = PhaseProfiler(sim_agent_phases, capacity, export_callback)
+        return self._profiler
+
+    def disable_profiling(self) -> None:
+        self._profiler = None
+
+    def set_trace_recorder(self, recorder) -> None:
+        """
+        Record the observation of each act() from now on
+        :param recorder: A TraceRecorder, or None to stop recording
+        """
+        self._trace_recorder = recorder
+
     def init_agent(self, id_, game_type):
         super(SimAgent, self).init_agent(id_, game_type)
+        # The simulated environment is kept for games of the same type, and only made again when it is used
+        if game_type != self._game_type:
+            self._sim_env_instance = None
+        self._game_type = game_type
 
-        self._sim_env = pommerman.make(pommerman.REGISTRY[game_type.value], self._generate_agents())
-        self._sim_env.reset()
+        if self._team_state is not None:
+            if self._character.teammate == agent_dummy:
+                raise ValueError('A team state is only used in team games')
+            self._team_member = int(id_ > agent_value_to_id(self._character.teammate.value))
 
     def reset(self, *args, **kwargs):
         self._character.reset(*args, **kwargs)
 
+        # The containers of the last game are cleared in place and reused, so nothing grows over games
         self._items.clear()
         self._agents.clear()
         self._dead_agents.clear()
         self._bombs.clear()
         self._id_to_agent.clear()
+        self._agent_positions.clear()
+        self._agent_store.clear()
+        self._bomb_store.clear()
+        if self._team_state is not None:
+            self._team_state.reset()
+        self._follows_team = False
 
         self._is_first_action = True
+        self._sim_env_obs = None
+        self._sim_env_step_obs = None
+        if self._trace_recorder is not None:
+            self._trace_recorder.new_episode()
 
         self._last_board = None
         self._board = None
@@ -81,17 +235,254 @@ class SimAgent(pommerman.agents.BaseAgent):
         self._alive_agents = None
         self._step_count = None
 
+        self._item_board = None
+        self._next_item_board = None
+        self._obs = None
+        self._flame_time_instance = None
+        self._distance_maps_instance = None
+        if self._distance_map_cache is not None:
+            self._distance_map_cache.clear()
+        self._state_hash_instance = None
+        self._planes_hash = None
+        self._hashed_planes = None
+        self._hashed_step = None
+
     def _act(self, obs, action_space):
         """The subclass should implement this class"""
         raise NotImplementedError
 
+    def shutdown(self):
+        if self._rollout_executor_instance is not None:
+            self._rollout_executor_instance.close()
+            self._rollout_executor_instance = None
+
+    @property
+    def _rollout_executor(self):
+        """
+        A RolloutExecutor whose worker processes hold simulated environments of the game, which is created on its
+        first access and closed by shutdown()
+        """
+        if self._rollout_executor_instance is None:
+            from rollout import RolloutExecutor
+            self._rollout_executor_instance = RolloutExecutor(self._game_type, len(self._generate_agents()))
+        return self._rollout_executor_instance
+
+    def _run_rollouts(self, obs, candidates: List[List[int]], num_rollouts: int, depth: int, time_limit: float):
+        """
+        Estimate candidate action sequences by rollouts in parallel from the simulated state of the current step
+        :param obs: The observation of the current step
+        :param candidates: Candidate action sequences of this agent, whose actions are values of actions
+        :param num_rollouts: The number of rollouts, which are spread over the candidates evenly
+        :param depth: The number of steps of a rollout
+        :param time_limit: Seconds from now, after which unfinished rollouts are dropped
+        :return: A RolloutResult, whose values are the mean rewards of the finished rollouts of each candidate
+        """
+        return self._rollout_executor.run(self._build_sim_state(obs), self._character.agent_id, candidates,
+                                          num_rollouts, depth, time_limit)
+
+    def _run_fast_rollouts(self, obs, candidates: List[List[int]], num_rollouts: int, depth: int,
+                           rng: np.random.Generator = None):
+        """
+        Estimate candidate action sequences like _run_rollouts(), where all rollouts are stepped together in this
+        process by fast_forward_model instead of simulated environments, so there is no deadline. Each rollout samples
+        the bombers which are not tracked.
+        :param obs: The observation of the current step
+        :param candidates: Candidate action sequences of this agent, whose actions are values of actions
+        :param num_rollouts: The number of rollouts, which are spread over the candidates evenly
+        :param depth: The number of steps of a rollout
+        :param rng: The random generator. A new one is created if it is None.
+        :return: A RolloutResult, whose values are the mean rewards of the rollouts of each candidate
+        """
+        from rollout import RolloutResult
+        from fast_forward_model import default_max_blast_strength, rollout as forward_rollout
+
+        if rng is None:
+            rng = np.random.default_rng()
+        candidate_indices = np.arange(num_rollouts) % len(candidates)
+        states = self._build_forward_states(obs, num_rollouts, rng)
+        env = self._get_sim_env_instance()
+        values = forward_rollout(states, self._character.agent_id, [candidates[i] for i in candidate_indices], depth,
+                                 self._game_type, rng, env._agent_view_size or default_max_blast_strength,
+                                 env._max_steps)
+
+        result = RolloutResult(len(candidates))
+        result.add(candidate_indices, values)
+        return result
+
+    def _build_forward_states(self, obs, num_states: int = 1, rng: np.random.Generator = None) -> ForwardStates:
+        """
+        Build copies of the state of the current step for fast_forward_model, each of which samples the bombers which
+        are not tracked like _build_sim_state()
+        :param obs: The observation of the current step
+        :param num_states: The number of copies
+        :param rng: The random generator. A new one is created if it is None.
+        :return: The batch of the copies
+        """
+        from fast_forward_model import ForwardStates
+
+        if rng is None:
+            rng = np.random.default_rng()
+        state, unknown_bomber_indices = self._build_base_sim_state(obs)
+        agent_ids = [agent[agent_id_obs] for agent in state['agents']]
+        state['bombs'] = [dict(bomb, bomber_id=agent_ids[0]) if bomb['bomber_id'] is None else bomb
+                          for bomb in state['bombs']]
+
+        states = ForwardStates.from_sim_states([state]).repeat(num_states)
+        states.bomb_bomber_ids[:, unknown_bomber_indices] = rng.choice(
+            agent_ids, size=(num_states, len(unknown_bomber_indices)))
+        return states
+
+    @property
+    def _sim_env(self):
+        """
+        The simulated environment, which is made on its first access. When create_sim_env is set, it is synchronized
+        with the current step on its first access in each step, so steps on which it is not used cost nothing.
+
+        A shared environment is synchronized again when another SimAgent has used it since, so a state loaded by
+        _restore_sim_env() or _load_sim_env_state() only lasts until then.
+        """
+        env = self._get_sim_env_instance()
+
+        obs = self._sim_env_obs
+        if obs is None and self._share_sim_env and not self._owns_sim_env():
+            obs = self._sim_env_step_obs
+
+        if obs is not None:
+            self._sim_env_obs = None
+            if self._profiler is None:
+                self._update_sim_env(obs)
+            else:
+                start = time.perf_counter_ns()
+                self._update_sim_env(obs)
+                self._profiler.record(update_sim_env_phase, time.perf_counter_ns() - start)
+        return env
+
     def _update_sim_env(self, obs):
-        sim_state = self._create_sim_state(obs)
-        self._sim_env._init_game_state = sim_state
-        self._sim_env.set_json_info()
-        self._sim_env._intended_actions = [i for i in literal_eval(sim_state[intended_actions_obs])]
+        _load_sim_state(self._claim_sim_env(), self._build_sim_state(obs))
+
+    def _get_sim_env_instance(self):
+        if self._sim_env_instance is None:
+            agents = self._generate_agents()
+            if self._share_sim_env:
+                key = (self._game_type.value, len(agents))
+                env = _shared_sim_envs.get(key)
+                if env is None:
+                    env = _make_sim_env(self._game_type, agents)
+                    _shared_sim_envs[key] = env
+                self._sim_env_instance = env
+            else:
+                self._sim_env_instance = _make_sim_env(self._game_type, agents)
+        return self._sim_env_instance
+
+    def _owns_sim_env(self) -> bool:
+        """Whether the state of the simulated environment is the last one loaded by this agent"""
+        return _sim_env_owners.get(id(self._sim_env_instance)) is self._sim_env_token
+
+    def _claim_sim_env(self):
+        """
+        Get the simulated environment to load a state of this agent into it
+        :return: The simulated environment
+        """
+        env = self._get_sim_env_instance()
+        if self._share_sim_env:
+            _sim_env_owners[id(env)] = self._sim_env_token
+        return env
+
+    @property
+    def _flame_time(self) -> np.ndarray:
+        """
+        The number of steps after which each cell is in flames, computed from the bombs on the board on its first
+        access in each step. See time_until_flame().
+        """
+        if self._flame_time_instance is None:
+            from flame_map import time_until_flame
+
+            start = time.perf_counter_ns()
+            self._flame_time_instance = time_until_flame(self._board, self._bomb_life, self._bomb_blast_strength)
+            if self._profiler is not None:
+                self._profiler.record(flame_time_phase, time.perf_counter_ns() - start)
+        return self._flame_time_instance
+
+    @property
+    def _state_hash(self) -> int:
+        """
+        The Zobrist hash of the state which _sim_env is synchronized with at the current step, computed on its first
+        access in each step. See ZobristHasher.
+        """
+        if self._state_hash_instance is None:
+            self._update_state_hash(self._obs)
+        return self._state_hash_instance
+
+    @property
+    def _distance_maps(self) -> np.ndarray:
+        """
+        The shortest distances in steps from each alive agent to all cells, of shape (num_agents, board_size,
+        board_size) and indexed by agent ids, where the maps of dead agents are unreachable everywhere. It is computed
+        on its first access in each step, and the maps are updated incrementally from the ones of the last steps.
+        """
+        if self._distance_maps_instance is None:
+            from distance_map import DistanceMapCache, passable_mask, unreachable
+
+            if self._distance_map_cache is None:
+                self._distance_map_cache = DistanceMapCache()
+            store = self._agent_store
+            agent_ids = np.flatnonzero(store.is_alive & (store.positions[:, 0] >= 0))
+            self._distance_maps_instance = np.full((len(store.ids),) + self._board.shape, unreachable)
+            self._distance_maps_instance[agent_ids] = self._distance_map_cache.get(
+                passable_mask(self._board), store.positions[agent_ids].tolist())
+        return self._distance_maps_instance
+
+    def _snapshot_sim_env(self, snapshot: _SimEnvSnapshot = None) -> _SimEnvSnapshot:
+        """
+        Take a snapshot of the simulated environment, e.g., before simulating a branch of a search
+        :param snapshot: A snapshot whose buffers are reused. A new one is created if it is None.
+        :return: The snapshot
+        """
+        env = self._sim_env
+        if snapshot is None:
+            snapshot = _SimEnvSnapshot(env._board_size, len(env._agents))
+        snapshot.capture(env)
+        return snapshot
+
+    def _restore_sim_env(self, snapshot: _SimEnvSnapshot) -> None:
+        """
+        Restore the simulated environment to a snapshot taken by _snapshot_sim_env()
+        :param snapshot: The snapshot
+        """
+        # The restored state must not be overwritten by a pending synchronization
+        self._sim_env_obs = None
+        snapshot.restore(self._claim_sim_env())
 
     def _create_sim_state(self, obs):
+        """
+        Create the JSON state of the simulated environment which env.set_json_info() accepts
+        :param obs: The observation of the current step
+        :return: A dict of JSON strings
+        """
+        state = self._build_sim_state(obs)
+        for key, value in state.items():
+            state[key] = json.dumps(value, cls=pommerman.utility.PommermanJSONEncoder)
+        return state
+
+    def _build_sim_state(self, obs):
+        """
+        Build the state of the simulated environment, which has the same fields as env.get_json_info()
+        but is not serialized
+        :param obs: The observation of the current step
+        :return: A dict of the state
+        """
+        state, unknown_bomber_indices = self._build_base_sim_state(obs)
+        for i in unknown_bomber_indices:
+            state['bombs'][i]['bomber_id'] = random.choice(state['agents'])[agent_id_obs]
+        return state
+
+    def _build_base_sim_state(self, obs):
+        """
+        Build the state of the simulated environment like _build_sim_state(), where the bombers of bombs which are
+        not tracked are left unresolved
+        :param obs: The observation of the current step
+        :return: A dict of the state and a list of indices of the bombs whose bomber_id is None
+        """
         def append_agent(_agents, _is_alive):
             if agent.id != self._character.agent_id:
                 _agents.append({
@@ -112,13 +503,10 @@ class SimAgent(pommerman.agents.BaseAgent):
                     'can_kick': obs[can_kick_obs]
                 })
 
-        board = self._board.tolist()
-        bomb_life = self._bomb_life.tolist()
-        bomb_blast_strength = self._bomb_blast_strength.tolist()
-        bombs_on_board, flames_ob_board = SimAgent._find_items(board, bomb_life, bomb_blast_strength)
         agents = []
         bombs = []
         flames = []
+        unknown_bomber_indices = []
 
         # Agents
         for agent in self._agents:
@@ -127,55 +515,125 @@ class SimAgent(pommerman.agents.BaseAgent):
             append_agent(agents, False)
 
         # Bombs
-        for bomb_on_board in bombs_on_board:
-            position = bomb_on_board[0]
-
-            recorded_bomb = None
-            for bomb in self._bombs:
-                if bomb.pos == position and not bomb.has_been_moved:
-                    recorded_bomb = bomb
-
+        recorded_bombs = {bomb.pos: bomb for bomb in self._bombs if not bomb.is_lost}
+        rows, cols = np.nonzero(self._bomb_life)
+        for row, col, life, blast_strength in zip(rows.tolist(), cols.tolist(),
+                                                  self._bomb_life[rows, cols].tolist(),
+                                                  self._bomb_blast_strength[rows, cols].tolist()):
+            recorded_bomb = recorded_bombs.get((row, col))
             if recorded_bomb is None:
-                bomber_id = random.choice(agents)[agent_id_obs]
+                bomber_id = None
+                moving_direction = None
+                unknown_bomber_indices.append(len(bombs))
             else:
                 bomber_id = recorded_bomb.bomber.id
+                moving_direction = recorded_bomb.moving_direction
+                if moving_direction is not None:
+                    moving_direction = moving_direction.value
 
             bombs.append({
-                'position': [position[0], position[1]],
+                'position': [row, col],
                 'bomber_id': bomber_id,
-                'life': bomb_on_board[1],
-                'blast_strength': bomb_on_board[2],
-                'moving_direction': None
+                'life': life,
+                'blast_strength': blast_strength,
+                'moving_direction': moving_direction
             })
 
         # Flames
-        for flame_obs in flames_ob_board:
-            position = flame_obs
+        for row, col in np.argwhere(self._board == flame_value).tolist():
             flames.append({
-                'position': [position[0], position[1]],
+                'position': [row, col],
                 'life': 2
             })
 
         # Items
         items = [
             [list(item.pos), item.type.value]
-            for item in self._items
+            for item in self._items.values()
         ]
 
-        state = {
+        return {
             'board_size': self._board.shape[0],
             'step_count': self._step_count,
-            'board': board,
+            'board': self._board,
             'agents': agents,
             'bombs': bombs,
             'flames': flames,
             'items': items,
             'intended_actions': []  # This is not considered in env.set_json_info(), so it can be ignored.
-        }
+        }, unknown_bomber_indices
 
-        for key, value in state.items():
-            state[key] = json.dumps(value, cls=pommerman.utility.PommermanJSONEncoder)
-        return state
+    def _sample_sim_states(self, obs, num_samples: int, rng: np.random.Generator = None) -> List[Dict]:
+        """
+        Sample determinizations of the state of the simulated environment, each of which samples the bombers which
+        are not tracked, the items hidden under wood by self._item_belief and the abilities of agents which may have
+        picked up hidden items. The unchanged parts of the states, e.g., the board and the flames, are shared by all
+        samples, so they must not be modified. A state is loaded by _load_sim_env_state().
+        :param obs: The observation of the current step
+        :param num_samples: The number of states
+        :param rng: The random generator. A new one is created if it is None.
+        :return: A list of the states
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        base_state, unknown_bomber_indices = self._build_base_sim_state(obs)
+        agents = base_state['agents']
+        bombs = base_state['bombs']
+        belief = self._item_belief
+
+        # Bombers
+        agent_ids = [agent[agent_id_obs] for agent in agents]
+        bomber_ids = rng.choice(agent_ids, size=(num_samples, len(unknown_bomber_indices))).tolist()
+
+        # Hidden items, each of which is under an unknown cell with the probability of the belief, so the items hidden
+        # in fog are not crowded into the visible cells
+        cells = np.argwhere(belief.unknown & ((self._board == wood_value) | (self._board == flame_value)))
+        has_items = rng.random((num_samples, len(cells))) < belief.probability[tuple(cells.T)]
+        item_values = np.array(hidden_item_values)[rng.integers(len(hidden_item_values), size=has_items.shape)]
+        cells = cells.tolist()
+
+        # Abilities
+        sampled_abilities = {}
+        for i, agent in enumerate(agents):
+            if agent[agent_id_obs] == self._character.agent_id or not agent['is_alive']:
+                continue
+            distribution = belief.ability_distribution(self._id_to_agent[agent[agent_id_obs]])
+            if len(distribution) > 1:
+                abilities = list(distribution)
+                choices = rng.choice(len(abilities), size=num_samples, p=list(distribution.values()))
+                sampled_abilities[i] = [abilities[choice] for choice in choices.tolist()]
+
+        states = []
+        for k in range(num_samples):
+            state = dict(base_state)
+
+            if len(unknown_bomber_indices) != 0:
+                state['bombs'] = list(bombs)
+                for i, bomber_id in zip(unknown_bomber_indices, bomber_ids[k]):
+                    state['bombs'][i] = dict(bombs[i], bomber_id=bomber_id)
+
+            if len(sampled_abilities) != 0:
+                state['agents'] = list(agents)
+                for i, abilities in sampled_abilities.items():
+                    ammo, blast_strength, can_kick = abilities[k]
+                    state['agents'][i] = dict(agents[i], ammo=ammo, blast_strength=blast_strength, can_kick=can_kick)
+
+            state['items'] = base_state['items'] + [
+                [cells[j], value] for j, value in zip(np.flatnonzero(has_items[k]).tolist(),
+                                                      item_values[k, has_items[k]].tolist())
+            ]
+            states.append(state)
+
+        return states
+
+    def _load_sim_env_state(self, state) -> None:
+        """
+        Load a state, e.g., one of the states sampled by _sample_sim_states(), into the simulated environment
+        :param state: The state
+        """
+        # The loaded state must not be overwritten by a pending synchronization
+        self._sim_env_obs = None
+        _load_sim_state(self._claim_sim_env(), state)
 
     def _generate_agents(self) -> List[_DummyAgent]:
         num_other_agents = len(self._character.enemies)
@@ -185,38 +643,166 @@ class SimAgent(pommerman.agents.BaseAgent):
         return agents
 
     def _init_obs(self, obs):
-        self._board = obs[board_obs]
-        self._bomb_life = obs[bomb_life_obs]
+        if self._trace_recorder is not None:
+            self._trace_recorder.record(obs)
+
+        # The observed planes are copied, since the environment may change them in place after this step
+        board = obs[board_obs]
+        if self._plane_buffers is None or self._plane_buffers.shape != board.shape:
+            self._plane_buffers = _PlaneBuffers(board.shape)
+        self._board, self._bomb_life, self._bomb_blast_strength = self._plane_buffers.fill(
+            board, obs[bomb_life_obs], obs[bomb_blast_strength_obs])
         self._alive_agents = obs[alive_agents_obs]
-        self._bomb_blast_strength = obs[bomb_blast_strength_obs]
         self._step_count = obs[step_count_obs]
+        if self._team_state is not None:
+            self._merge_team_planes()
+        self._locate_agents()
+
+    def _merge_team_planes(self):
+        """
+        Publish the observed planes to the teammate, and fill the fog of the planes with the ones of the teammate.
+        This agent follows the tracking of the teammate if the teammate has tracked the current step, otherwise it
+        tracks the step for both.
+        """
+        team_state = self._team_state
+        planes = self._plane_buffers.current_buffers()
+        team_state.publish_observation(self._team_member, self._step_count, *planes)
+
+        self._follows_team = team_state.tracked_step == self._step_count
+        if self._follows_team:
+            team_state.merge_as_follower(*planes)
+        else:
+            team_state.merge_as_leader(self._team_member, self._step_count, *planes)
+
+    def _follow_team(self):
+        """Take the tracking of the current step published by the teammate instead of tracking it"""
+        if self._is_first_action:
+            self._is_first_action = False
+            self._init_items()
+
+        arrays = self._team_state.arrays
+        agent_store = self._agent_store
+        for agent_id in np.flatnonzero(agent_store.values >= first_agent_value).tolist():
+            self._id_to_agent[agent_id] = agent_store.agents[agent_id]
+        self._agents[:] = [agent_store.agents[agent_id] for agent_id in np.flatnonzero(agent_store.is_alive).tolist()]
+        self._dead_agents[:] = [agent_store.agents[agent_id]
+                                for agent_id in np.flatnonzero(arrays['agent_died']).tolist()]
+        # The leader may only know the positions of the step before for the agents which this agent sees
+        for agent in self._agents:
+            pos = self._agent_positions.get(agent.value)
+            if pos is not None:
+                agent.pos = pos
+
+        bomb_store = self._bomb_store
+
+        def bomb_views(mask):
+            return [bomb_store.bombs[slot] if bomb_store.bombs[slot] is not None else _Bomb.view(bomb_store, slot)
+                    for slot in np.flatnonzero(mask).tolist()]
+
+        self._bombs = bomb_views(bomb_store.active)
+        new_bombs = bomb_views(arrays['bomb_new'])
+        new_moving_bombs = bomb_views(arrays['bomb_new_moving'])
+
+        np.copyto(self._next_item_board, arrays['item_board'])
+        self._apply_item_board(self._next_item_board)
+        self._item_belief.update(self._board, new_bombs, new_moving_bombs)
+
+    def _publish_team_tracking(self, new_bombs: List[_Bomb], new_moving_bombs: List[_Bomb]) -> None:
+        """Publish the tracking of the current step to the teammate, which is in the team state except these"""
+        if self._team_state is None:
+            return
+
+        arrays = self._team_state.arrays
+        np.copyto(arrays['item_board'], self._item_board)
+        arrays['agent_died'].fill(False)
+        arrays['agent_died'][[agent.id for agent in self._dead_agents]] = True
+        arrays['bomb_new'].fill(False)
+        arrays['bomb_new'][[bomb._slot for bomb in new_bombs]] = True
+        arrays['bomb_new_moving'].fill(False)
+        arrays['bomb_new_moving'][[bomb._slot for bomb in new_moving_bombs]] = True
+        self._team_state.tracked_step = self._step_count
+
+    def _locate_agents(self):
+        """
+        Index the positions of all agents on the board with a single scan. In team games, the agents seen by the
+        teammate in the step before are located there as well when this agent leads and only sees fog there.
+        """
+        self._agent_positions.clear()
+        for row, col in np.argwhere(self._board >= first_agent_value):
+            self._agent_positions[int(self._board[row, col])] = _Pos((int(row), int(col)))
+
+        team_state = self._team_state
+        if team_state is not None:
+            team_state.publish_agent_positions(self._team_member, self._agent_positions)
+            if not self._follows_team:
+                for agent_value, pos in team_state.teammate_agent_positions(self._team_member,
+                                                                            self._step_count).items():
+                    if agent_value not in self._agent_positions and self._board[pos] == fog_value:
+                        self._agent_positions[agent_value] = _Pos(pos)
+
+    def _update_state_hash(self, obs):
+        """Update the hash of the state, where this agent has the abilities in obs like _build_sim_state()"""
+        from zobrist import default_hasher
+
+        planes = (self._board, self._bomb_life, self._bomb_blast_strength)
+        if self._planes_hash is None or self._hashed_step != self._step_count - 1:
+            self._planes_hash = default_hasher.hash_planes(*planes)
+        else:
+            self._planes_hash = default_hasher.update_planes(self._planes_hash, self._hashed_planes, planes)
+        self._hashed_planes = planes
+        self._hashed_step = self._step_count
+
+        store = self._agent_store
+        agent_ids = np.flatnonzero(store.is_alive & (store.positions[:, 0] >= 0))
+        ammo = store.ammo[agent_ids]
+        blast_strength = store.blast_strength[agent_ids]
+        can_kick = store.can_kick[agent_ids]
+        is_self = agent_ids == self._character.agent_id
+        ammo[is_self] = obs[ammo_obs]
+        blast_strength[is_self] = obs[blast_strength_obs]
+        can_kick[is_self] = obs[can_kick_obs]
+
+        bomb_store = self._bomb_store
+        moving = np.flatnonzero(bomb_store.active & ~bomb_store.lost & (bomb_store.directions != 0))
+
+        self._state_hash_instance = self._planes_hash ^ default_hasher.hash_agents(
+            agent_ids, store.positions[agent_ids], ammo, blast_strength, can_kick) ^ \
+            default_hasher.hash_moving_bombs(bomb_store.positions[moving], bomb_store.directions[moving])
+
+    def _init_items(self):
+        """Initialize simulation of items"""
+        self._item_board = np.zeros(self._board.shape, dtype=_item_value_table.dtype)
+        self._next_item_board = np.zeros_like(self._item_board)
+        self._item_belief.reset(self._board)
 
     def _update_items(self) -> List[_Item]:
         """
         Update the observable items on the board
         :return: A list of missing items which are present at the last step
         """
-        # Get missing items
+        return self._apply_item_board(np.take(_item_value_table, self._board, out=self._next_item_board))
+
+    def _apply_item_board(self, item_board: np.ndarray) -> List[_Item]:
+        """
+        Update the observable items with the item board of the current step, which is _next_item_board
+        :return: A list of missing items which are present at the last step
+        """
+        # Only the cells whose item value differs from the last step can have a missing or a new item
         missing_items = []
-        for item in self._items:
-            row = item.pos[0]
-            col = item.pos[1]
-            if self._board[row][col] != item.type.value:
-                missing_items.append(item)
-        for item in missing_items:
-            self._items.remove(item)
+        for row, col in np.argwhere(item_board != self._item_board):
+            pos = _Pos((int(row), int(col)))
 
-        # Update items on the board
-        for row in range(len(self._board)):
-            for col in range(len(self._board[0])):
-                if _ItemType.contains(self._board[row][col]):
-                    item_type = _ItemType.get_type(self._board[row][col])
-                    new_item = _Item(item_type, _Pos((row, col)))
+            missing_item = self._items.pop(pos, None)
+            if missing_item is not None:
+                missing_items.append(missing_item)
 
-                    if new_item not in self._items:
-                        # Find new items
-                        self._items.append(new_item)
+            item_value = item_board[row, col]
+            if item_value != 0:
+                # Find new items
+                self._items[pos] = _Item(_ItemType(int(item_value)), pos)
 
+        self._next_item_board = self._item_board
+        self._item_board = item_board
         return missing_items
 
     def _update_bombs(self) -> Tuple[List[_Bomb], List[_Bomb], List[_Bomb]]:
@@ -224,56 +810,79 @@ class SimAgent(pommerman.agents.BaseAgent):
         Update the observable bombs on the board
         :return: A list of exploded bombs, a list of new laid bombs and a list of new moving bombs
         """
+        store = self._bomb_store
+        agent_store = self._agent_store
+        rows = store.positions[:, 0]
+        cols = store.positions[:, 1]
+
         # Update life of bombs
-        for bomb in self._bombs:
-            bomb.update_life()
+        store.life[store.active] -= bomb_life_reduction
+
+        # Update the moving state of bombs: a stopped bomb is kicked when another agent stands at its position
+        kicker_ids = self._board[rows, cols].astype(np.int64) - first_agent_value
+        is_agent = (kicker_ids >= 0) & (kicker_ids < NUM_AGENTS)
+        kicker_ids[~is_agent] = 0
+        kicked = store.active & ~store.lost & (store.directions == 0) & is_agent & \
+            agent_store.is_alive[kicker_ids] & (agent_store.positions[kicker_ids] != store.positions).any(axis=1)
 
-        # Update the moving state of bombs
         new_moving_bombs = []
-        for bomb in self._bombs:
+        for slot in np.flatnonzero(kicked):
+            bomb = store.bombs[slot]
+            direction = self._get_moving_direction(self._id_to_agent[kicker_ids[slot]])
             if not bomb.has_been_moved:
-                for agent in self._agents:
-                    if agent.pos != bomb.pos and \
-                            self._board[bomb.pos[0]][bomb.pos[1]] == agent.value:
-                        # A bomb is kicked
-                        bomb.has_been_moved = True
-                        bomb.first_moving_direction = self._get_moving_direction(agent)
-                        new_moving_bombs.append(bomb)
-
-        # Get exploded bombs
-        exploded_bomb = []
-        for bomb in self._bombs:
-            if bomb.has_been_moved:
-                # Use bomb life to predict whether a bomb is exploded
-                if bomb.life == end_bomb_life:
-                    exploded_bomb.append(bomb)
-            else:
-                # The position of stopped bomb is accurate.
-                if self._bomb_life[bomb.pos[0]][bomb.pos[1]] == end_bomb_life:
-                    exploded_bomb.append(bomb)
-        for bomb in exploded_bomb:
-            self._bombs.remove(bomb)
+                bomb.has_been_moved = True
+                bomb.first_moving_direction = direction
+            store.directions[slot] = direction.value
+            new_moving_bombs.append(bomb)
+
+        # Follow moving bombs, including the ones kicked from their positions in this step
+        found, exploded_moving = _track_moving_bombs(
+            self._board[None], self._bomb_life[None], self._bomb_blast_strength[None],
+            (store.active & ~store.lost & (store.directions != 0))[None],
+            (store.active & ~store.lost & (store.directions == 0))[None], store.positions[None], store.life[None],
+            store.blast_strength[None], store.directions[None])
+        store.lost |= store.active & (store.directions != 0) & ~found[0] & ~exploded_moving[0]
+
+        # Get exploded bombs. The position of a followed bomb is accurate, otherwise its life is used for prediction.
+        exploded = store.active & (exploded_moving[0] | np.where(store.lost,
+                                                                 store.life == end_bomb_life,
+                                                                 self._bomb_life[rows, cols] == end_bomb_life))
+        exploded_slots = np.flatnonzero(exploded)
+        exploded_bombs = [store.bombs[slot] for slot in exploded_slots]
 
         # Get new laid bombs
+        has_pos = agent_store.is_alive & (agent_store.positions[:, 0] >= 0)
+        agent_positions = agent_store.positions * has_pos[:, None]
+        is_new = has_pos & (self._bomb_life[agent_positions[:, 0], agent_positions[:, 1]] == initial_bomb_life)
         new_bombs = []
-        for agent in self._agents:
-            if self._bomb_life[agent.pos[0]][agent.pos[1]] == initial_bomb_life:
-                new_bomb = _Bomb(agent, agent.pos, self._bomb_blast_strength[agent.pos[0]][agent.pos[1]],
-                                 initial_bomb_life)
-                self._bombs.append(new_bomb)
-                new_bombs.append(new_bomb)
+        for agent_id in np.flatnonzero(is_new):
+            agent = self._id_to_agent[agent_id]
+            row, col = agent_positions[agent_id]
+            new_bombs.append(_Bomb(agent, agent.pos, self._bomb_blast_strength[row, col], initial_bomb_life,
+                                   store=store))
 
-        return exploded_bomb, new_bombs, new_moving_bombs
+        # Exploded bombs are released after new bombs are laid, so they are not overwritten in this step
+        if exploded_bombs or new_bombs:
+            store.active[exploded_slots] = False
+            self._bombs = [store.bombs[slot] for slot in np.flatnonzero(store.active)]
+
+        return exploded_bombs, new_bombs, new_moving_bombs
 
     def _init_agents(self):
-        """Initialize simulation of agents"""
+        """
+        Initialize simulation of agents. All agents are alive at the first step, and the ones which are not seen are
+        at the corners where they start.
+        """
+        num_agents = len(self._alive_agents)
         for agent_value in self._alive_agents:
-            agent_pos = SimAgent._get_agent_pos(self._board, agent_value)
-            if agent_pos is not None:
-                agent = _Agent(agent_value_to_id(agent_value), agent_value, agent_pos, initial_ammo,
-                               initial_blast_strength, initial_kick_ability)
-                self._id_to_agent[agent.id] = agent
-                self._agents.append(agent)
+            agent_id = agent_value_to_id(agent_value)
+            agent_pos = self._agent_positions.get(agent_value)
+            if agent_pos is None:
+                agent_pos = _Pos(initial_agent_position(agent_id, num_agents, self._board.shape[0]))
+            agent = self._agent_store.agents[agent_id]
+            agent.reset(agent_id, agent_value, agent_pos, initial_ammo, initial_blast_strength, initial_kick_ability)
+            self._id_to_agent[agent.id] = agent
+            self._agents.append(agent)
 
     def _update_agents(self,
                        missing_items: List[_Item],
@@ -287,13 +896,21 @@ class SimAgent(pommerman.agents.BaseAgent):
         :param new_bombs: A list of bombs newly laid in the current step
         :param new_moving_bombs: A list of bombs able to move in the current step but unable in the last step
         """
-        # Remove dead agents
-        self._dead_agents = list(agent for agent in self._agents if agent.value not in self._alive_agents)
-        self._agents = list(set(self._agents) - set(self._dead_agents))
+        # Move dead agents from _agents to _dead_agents in place, keeping the order of the alive ones
+        self._dead_agents.clear()
+        num_alive = 0
+        for agent in self._agents:
+            if agent.value in self._alive_agents:
+                self._agents[num_alive] = agent
+                num_alive += 1
+            else:
+                self._dead_agents.append(agent)
+                self._agent_store.is_alive[agent.id] = False
+        del self._agents[num_alive:]
 
         # Update position
         for agent in self._agents:
-            agent.pos = SimAgent._get_agent_pos(self._board, agent.value)
+            agent.pos = self._agent_positions.get(agent.value)
 
         # Update ability
         for item in missing_items:
@@ -308,17 +925,18 @@ class SimAgent(pommerman.agents.BaseAgent):
             self._id_to_agent[bomb.bomber.id].can_kick = True
 
         # Update ammo
+        is_alive = self._agent_store.is_alive
         for bomb in exploded_bombs:
-            for agent in self._agents:
-                if agent == bomb.bomber:
-                    agent.ammo += 1
+            if is_alive[bomb.bomber.id]:
+                bomb.bomber.ammo += 1
         for bomb in new_bombs:
-            for agent in self._agents:
-                if agent == bomb.bomber:
-                    agent.ammo -= 1
+            if is_alive[bomb.bomber.id]:
+                bomb.bomber.ammo -= 1
+
+        self._item_belief.update(self._board, new_bombs, new_moving_bombs)
 
     def _get_moving_direction(self, agent: _Agent) -> ActionType:
-        new_x, new_y = SimAgent._get_agent_pos(self._board, agent.value)
+        new_x, new_y = self._agent_positions[agent.value]
         old_x, old_y = agent.pos
 
         if new_x == old_x and new_y == old_y + 1:
@@ -330,20 +948,6 @@ class SimAgent(pommerman.agents.BaseAgent):
         else:
             return action_up
 
-    @staticmethod
-    def _find_items(board, bomb_life, bomb_blast_strength):
-        bombs = []
-        flames = []
-
-        for row in range(len(board)):
-            for col in range(len(board[0])):
-                if bomb_life[row][col] != 0:
-                    bombs.append(((row, col), bomb_life[row][col], bomb_blast_strength[row][col]))
-                if board[row][col] == flame_value:
-                    flames.append((row, col))
-
-        return bombs, flames
-
     @staticmethod
     def _get_agent_pos(board, agent_value: AgentValueType) -> _Pos:
         """
@@ -358,6 +962,146 @@ class SimAgent(pommerman.agents.BaseAgent):
                     return _Pos((row, col))
 
 
+# Simulated environments shared by the SimAgents of the process, keyed by game types and numbers of agents
+_shared_sim_envs = {}
+# The token of the SimAgent whose state is loaded in each shared environment, keyed by ids of the environments
+_sim_env_owners = {}
+
+
+def _make_sim_env(game_type, agents: List[_DummyAgent]):
+    env = pommerman.make(pommerman.REGISTRY[game_type.value], agents)
+    env.reset()
+    return env
+
+
+def _load_sim_state(env, state) -> None:
+    """
+    Load a state built by SimAgent._build_sim_state() into a simulated environment. The result is the same
+    as env.set_json_info() with the serialized state, but nothing is serialized. The agents of the environment which
+    are not in the state are dead, since a state only has the agents which died at its own step.
+    :param env: The simulated environment
+    :param state: The state of the simulated environment
+    """
+    env._board_size = int(state['board_size'])
+    env._step_count = int(state['step_count'])
+    board = state['board']
+    if isinstance(env._board, np.ndarray) and env._board.shape == np.shape(board) and env._board.flags.writeable:
+        np.copyto(env._board, board, casting='unsafe')
+    else:
+        env._board = np.array(board, dtype=np.uint8)
+    env._items = {tuple(pos): value for pos, value in state['items']}
+
+    id_to_env_agent = {agent.agent_id: agent for agent in env._agents}
+    for agent in state['agents']:
+        env_agent = id_to_env_agent[agent['agent_id']]
+        env_agent.set_start_position(tuple(agent['position']))
+        env_agent.reset(int(agent['ammo']), bool(agent['is_alive']), int(agent['blast_strength']),
+                        bool(agent['can_kick']))
+    # The agents which died at earlier steps, which may be alive in the environment if it was not synchronized at the
+    # step they died or another SimAgent loaded its state into a shared environment since
+    if len(state['agents']) != len(env._agents):
+        agent_ids = {agent['agent_id'] for agent in state['agents']}
+        for env_agent in env._agents:
+            if env_agent.agent_id not in agent_ids:
+                env_agent.die()
+
+    env._bombs = []
+    for bomb in state['bombs']:
+        moving_direction = bomb['moving_direction']
+        if moving_direction is not None:
+            moving_direction = ActionType(moving_direction)
+        env._bombs.append(characters.Bomb(id_to_env_agent[bomb['bomber_id']], tuple(bomb['position']),
+                                          int(bomb['life']), int(bomb['blast_strength']), moving_direction))
+
+    env._flames = [characters.Flame(tuple(flame['position']), flame['life']) for flame in state['flames']]
+    env._intended_actions = list(state['intended_actions'])
+
+
+class _SimEnvSnapshot(object):
+    __slots__ = ['board', 'step_count', 'positions', 'ammo', 'blast_strength', 'can_kick', 'is_alive', 'bombs',
+                 'num_bombs', 'flames', 'num_flames', 'items', 'intended_actions']
+
+    def __init__(self, board_size: int, num_agents: int):
+        self.board = np.empty((board_size, board_size), dtype=np.uint8)
+        self.step_count = 0
+        self.positions = np.empty((num_agents, 2), dtype=np.int64)
+        self.ammo = np.empty(num_agents, dtype=np.int64)
+        self.blast_strength = np.empty(num_agents, dtype=np.int64)
+        self.can_kick = np.empty(num_agents, dtype=bool)
+        self.is_alive = np.empty(num_agents, dtype=bool)
+        # Entries of bombs and flames, where the first num_bombs and num_flames are captured and the others are kept
+        # for the next captures
+        self.bombs: List[list] = []
+        self.num_bombs = 0
+        self.flames: List[list] = []
+        self.num_flames = 0
+        self.items = {}
+        self.intended_actions = []
+
+    def capture(self, env) -> None:
+        """Copy the state of a simulated environment into this snapshot"""
+        np.copyto(self.board, env._board)
+        self.step_count = env._step_count
+
+        for i, agent in enumerate(env._agents):
+            self.positions[i] = agent.position
+            self.ammo[i] = agent.ammo
+            self.blast_strength[i] = agent.blast_strength
+            self.can_kick[i] = agent.can_kick
+            self.is_alive[i] = agent.is_alive
+
+        # Bombs and flames are recreated on restore since stepping the environment mutates them, and their entries
+        # are overwritten in place
+        bombs = self.bombs
+        for i, bomb in enumerate(env._bombs):
+            if i == len(bombs):
+                bombs.append([None] * 5)
+            entry = bombs[i]
+            entry[0] = bomb.bomber.agent_id
+            entry[1] = bomb.position
+            entry[2] = bomb.life
+            entry[3] = bomb.blast_strength
+            entry[4] = bomb.moving_direction
+        self.num_bombs = len(env._bombs)
+
+        flames = self.flames
+        for i, flame in enumerate(env._flames):
+            if i == len(flames):
+                flames.append([None] * 2)
+            entry = flames[i]
+            entry[0] = flame.position
+            entry[1] = flame.life
+        self.num_flames = len(env._flames)
+
+        self.items.clear()
+        self.items.update(env._items)
+        self.intended_actions[:] = env._intended_actions
+
+    def restore(self, env) -> None:
+        """Write this snapshot back into a simulated environment"""
+        np.copyto(env._board, self.board)
+        env._step_count = self.step_count
+
+        id_to_env_agent = {}
+        for i, agent in enumerate(env._agents):
+            # Agents of the environment only delegate reading attributes to their characters
+            character = agent._character
+            character.position = (int(self.positions[i, 0]), int(self.positions[i, 1]))
+            character.ammo = int(self.ammo[i])
+            character.blast_strength = int(self.blast_strength[i])
+            character.can_kick = bool(self.can_kick[i])
+            character.is_alive = bool(self.is_alive[i])
+            id_to_env_agent[agent.agent_id] = agent
+
+        env._bombs = [
+            characters.Bomb(id_to_env_agent[bomber_id], position, life, blast_strength, moving_direction)
+            for bomber_id, position, life, blast_strength, moving_direction in self.bombs[:self.num_bombs]
+        ]
+        env._flames = [characters.Flame(position, life) for position, life in self.flames[:self.num_flames]]
+        env._items = dict(self.items)
+        env._intended_actions = list(self.intended_actions)
+
+
 class _DummyAgent(pommerman.agents.BaseAgent):
     def act(self, obs, action_space):
         pass
@@ -371,21 +1115,155 @@ class _ItemType(Enum):
     INCREASE_RANGE = increase_range_value
     ENABLE_KICK = enable_kick_value
 
-    @classmethod
-    def contains(cls, value):
-        return any(value == item.value for item in cls)
 
-    @classmethod
-    def get_type(cls, value):
-        # noinspection PyTypeChecker
-        for _, item in cls.__members__.items():
-            if item.value == value:
-                return item
-        return None
+_item_values = np.array([item.value for item in _ItemType])
+
+# Maps the values on a board to themselves for items and to 0 otherwise
+_item_value_table = np.zeros(256, dtype=np.uint8)
+_item_value_table[_item_values] = _item_values
+
+# Offsets of a position moved by the values of actions, where Stop and Bomb do not move
+_direction_offsets = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1], [0, 0]], dtype=np.int64)
+_move_directions = np.array([action.value for action in [action_up, action_down, action_left, action_right]])
+
+
+def _track_moving_bombs(boards: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray,
+                        moving: np.ndarray, stopped: np.ndarray, positions: np.ndarray, life: np.ndarray,
+                        blast_strength: np.ndarray, directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Follow moving bombs of a batch of games by one step. In a step, a moving bomb keeps moving in its direction, stops
+    when it is blocked, or is kicked into another direction, so it is matched with the cells holding a bomb of its
+    life and blast strength in this order: the next cell in its direction, its cell and the cells next to it. The
+    cells of bombs which do not move are not matched.
+    :param boards: Boards of shape (N, H, W)
+    :param bomb_life: Bomb life planes of the same shape
+    :param bomb_blast_strength: Bomb blast strength planes of the same shape
+    :param moving: A mask of shape (N, C) of the bombs to follow
+    :param stopped: A mask of shape (N, C) of the bombs which do not move
+    :param positions: Positions of the bombs at the last step of shape (N, C, 2), which are updated in place
+    :param life: Life of the bombs at the current step of shape (N, C)
+    :param blast_strength: Blast strength of the bombs of shape (N, C)
+    :param directions: Values of the moving directions of the bombs of shape (N, C), which are updated in place and
+    are 0 once the bombs stop
+    :return: A mask of the bombs which are found, and a mask of the bombs which are not found but have exploded,
+    i.e., there are flames where they would be after moving or stopping
+    """
+    found = np.zeros_like(moving)
+    exploded = np.zeros_like(moving)
+    games, slots = np.nonzero(moving)
+    if len(games) == 0:
+        return found, exploded
+
+    num_bombs = len(games)
+    candidate_directions = np.concatenate([directions[games, slots][:, None],
+                                           np.zeros((num_bombs, 1), dtype=np.int64),
+                                           np.broadcast_to(_move_directions, (num_bombs, len(_move_directions)))],
+                                          axis=1)
+    candidates = positions[games, slots][:, None] + _direction_offsets[candidate_directions]
+    on_board = ((candidates >= 0) & (candidates < boards.shape[1])).all(axis=2)
+    candidates = np.clip(candidates, 0, boards.shape[1] - 1)
+
+    occupied = np.zeros(boards.shape, dtype=bool)
+    stopped_games, stopped_slots = np.nonzero(stopped)
+    stopped_positions = positions[stopped_games, stopped_slots]
+    occupied[stopped_games, stopped_positions[:, 0], stopped_positions[:, 1]] = True
+
+    game_index = games[:, None]
+    rows, cols = candidates[..., 0], candidates[..., 1]
+    matches = on_board & ~occupied[game_index, rows, cols] & \
+        (bomb_life[game_index, rows, cols] == life[games, slots][:, None]) & \
+        (bomb_blast_strength[game_index, rows, cols] == blast_strength[games, slots][:, None])
+    is_found = matches.any(axis=1)
+    choices = matches.argmax(axis=1)
+    bomb_index = np.arange(num_bombs)
+
+    games_found, slots_found = games[is_found], slots[is_found]
+    positions[games_found, slots_found] = candidates[bomb_index, choices][is_found]
+    directions[games_found, slots_found] = candidate_directions[bomb_index, choices][is_found]
+    found[games_found, slots_found] = True
+
+    in_flames = on_board[:, :2] & (boards[game_index, rows[:, :2], cols[:, :2]] == flame_value)
+    is_exploded = ~is_found & in_flames.any(axis=1)
+    exploded[games[is_exploded], slots[is_exploded]] = True
+    return found, exploded
+
+
+class _PlaneBuffers(object):
+    """
+    Two preallocated sets of the board, bomb life and bomb blast strength planes, which are filled with observations
+    in turns, so the planes of the last step stay valid while the ones of the current step are filled without any
+    allocation. The planes are given as read-only views.
+    """
+    __slots__ = ['shape', '_buffers', '_views', '_current']
+
+    def __init__(self, shape: Tuple[int, int]):
+        self.shape = shape
+        self._buffers = [
+            (np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=np.float64), np.zeros(shape, dtype=np.float64))
+            for _ in range(2)
+        ]
+        self._views = [tuple(_read_only_view(plane) for plane in planes) for planes in self._buffers]
+        self._current = 0
+
+    def fill(self, board: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray
+             ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Copy the planes of a step into the buffers not holding the last step
+        :return: Read-only views of the board, the bomb life and the bomb blast strength
+        """
+        self._current ^= 1
+        for buffer, plane in zip(self._buffers[self._current], (board, bomb_life, bomb_blast_strength)):
+            np.copyto(buffer, plane, casting='unsafe')
+        return self._views[self._current]
+
+    def current_buffers(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: The writable buffers of the planes of the current step
+        """
+        return self._buffers[self._current]
+
+
+def _read_only_view(array: np.ndarray) -> np.ndarray:
+    view = array.view()
+    view.setflags(write=False)
+    return view
+
+
+class _AgentStore(object):
+    """
+    Arrays of the attributes of agents indexed by slots, which are viewed by _Agent. The view of each slot is made
+    once and reused by all games.
+    """
+    __slots__ = ['ids', 'values', 'positions', 'ammo', 'blast_strength', 'can_kick', 'is_alive', 'agents']
+
+    def __init__(self, capacity: int, arrays: Dict[str, np.ndarray] = None):
+        """
+        :param capacity: The number of slots
+        :param arrays: Existing arrays of the attributes, e.g., in a TeamState, which are used instead of new ones
+        """
+        if arrays is not None:
+            for name, array in arrays.items():
+                setattr(self, name, array)
+            self.agents: List[_Agent] = [_Agent.view(self, slot) for slot in range(len(self.ids))]
+            return
+
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.full((capacity, 2), -1, dtype=np.int64)
+        self.ammo = np.zeros(capacity, dtype=np.int64)
+        self.blast_strength = np.zeros(capacity, dtype=np.float64)
+        self.can_kick = np.zeros(capacity, dtype=bool)
+        # Whether an agent is in SimAgent._agents
+        self.is_alive = np.zeros(capacity, dtype=bool)
+        self.agents: List[_Agent] = [_Agent.view(self, slot) for slot in range(capacity)]
+
+    def clear(self):
+        self.positions.fill(-1)
+        self.is_alive.fill(False)
 
 
 class _Agent(object):
-    __slots__ = ['id', 'value', 'pos', 'ammo', 'blast_strength', 'can_kick']
+    __slots__ = ['_store', '_slot']
 
     def __init__(self,
                  agent_id: AgentIdType,
@@ -393,13 +1271,90 @@ class _Agent(object):
                  pos: _Pos,
                  ammo: AmmoType,
                  blast_strength: BlastStrengthType,
-                 can_kick: bool):
+                 can_kick: bool,
+                 store: _AgentStore = None,
+                 slot: int = 0):
+        if store is None:
+            store = _AgentStore(1)
+            slot = 0
+        self._store = store
+        self._slot = slot
+        self.reset(agent_id, agent_value, pos, ammo, blast_strength, can_kick)
+
+    @classmethod
+    def view(cls, store: _AgentStore, slot: int) -> _Agent:
+        """View a slot whose attributes are set elsewhere, e.g., by a teammate sharing the store"""
+        agent = cls.__new__(cls)
+        agent._store = store
+        agent._slot = slot
+        return agent
+
+    def reset(self,
+              agent_id: AgentIdType,
+              agent_value: AgentValueType,
+              pos: _Pos,
+              ammo: AmmoType,
+              blast_strength: BlastStrengthType,
+              can_kick: bool) -> None:
+        """Set all attributes of the slot, e.g., to track an agent of a new game with a reused view"""
         self.id = agent_id
         self.value = agent_value
         self.pos = pos
         self.ammo = ammo
         self.blast_strength = blast_strength
         self.can_kick = can_kick
+        self._store.is_alive[self._slot] = True
+
+    @property
+    def id(self) -> AgentIdType:
+        return int(self._store.ids[self._slot])
+
+    @id.setter
+    def id(self, agent_id: AgentIdType):
+        self._store.ids[self._slot] = agent_id
+
+    @property
+    def value(self) -> AgentValueType:
+        return int(self._store.values[self._slot])
+
+    @value.setter
+    def value(self, agent_value: AgentValueType):
+        self._store.values[self._slot] = agent_value
+
+    @property
+    def pos(self) -> _Pos:
+        row, col = self._store.positions[self._slot]
+        if row < 0:
+            return None
+        return _Pos((int(row), int(col)))
+
+    @pos.setter
+    def pos(self, pos: _Pos):
+        self._store.positions[self._slot] = (-1, -1) if pos is None else pos
+
+    @property
+    def ammo(self) -> AmmoType:
+        return int(self._store.ammo[self._slot])
+
+    @ammo.setter
+    def ammo(self, ammo: AmmoType):
+        self._store.ammo[self._slot] = ammo
+
+    @property
+    def blast_strength(self) -> BlastStrengthType:
+        return float(self._store.blast_strength[self._slot])
+
+    @blast_strength.setter
+    def blast_strength(self, blast_strength: BlastStrengthType):
+        self._store.blast_strength[self._slot] = blast_strength
+
+    @property
+    def can_kick(self) -> bool:
+        return bool(self._store.can_kick[self._slot])
+
+    @can_kick.setter
+    def can_kick(self, can_kick: bool):
+        self._store.can_kick[self._slot] = can_kick
 
     def __hash__(self):
         return hash(self.id)
@@ -434,17 +1389,173 @@ class _Item(object):
                self.pos[1] == other.pos[1]
 
 
+class _BombStore(object):
+    """
+    Arrays of the attributes of bombs indexed by slots, which are viewed by _Bomb. A slot is reused once its bomb is
+    not active, so a _Bomb is only valid while it is tracked.
+    """
+    __slots__ = ['active', 'positions', 'life', 'blast_strength', 'bomber_ids', 'moved', 'moving_directions',
+                 'directions', 'lost', 'bombs', 'id_to_agent', 'fixed']
+
+    def __init__(self, capacity: int, id_to_agent: Dict[AgentIdType, _Agent], arrays: Dict[str, np.ndarray] = None):
+        """
+        :param capacity: The initial number of slots
+        :param id_to_agent: Agents keyed by their ids
+        :param arrays: Existing arrays of the attributes, e.g., in a TeamState, which are used instead of new ones and
+        are not grown
+        """
+        # Used to get bombers by their ids
+        self.id_to_agent = id_to_agent
+
+        if arrays is not None:
+            for name, array in arrays.items():
+                setattr(self, name, array)
+            self.bombs: List[_Bomb] = [None] * len(self.active)
+            self.fixed = True
+            return
+        self.fixed = False
+
+        self.active = np.zeros(capacity, dtype=bool)
+        self.positions = np.zeros((capacity, 2), dtype=np.int64)
+        self.life = np.zeros(capacity, dtype=np.float64)
+        self.blast_strength = np.zeros(capacity, dtype=np.float64)
+        self.bomber_ids = np.zeros(capacity, dtype=np.int64)
+        self.moved = np.zeros(capacity, dtype=bool)
+        # The value of an action, or 0 if a bomb has not been moved
+        self.moving_directions = np.zeros(capacity, dtype=np.int64)
+        # The value of the action a bomb is moving in at the current step, or 0 if it does not move
+        self.directions = np.zeros(capacity, dtype=np.int64)
+        # Whether a moving bomb cannot be followed on the board, after which its position is not updated
+        self.lost = np.zeros(capacity, dtype=bool)
+        self.bombs: List[_Bomb] = [None] * capacity
+
+    def clear(self):
+        self.active.fill(False)
+        # The bombs of the last game are released, while the slots are kept
+        self.bombs[:] = [None] * len(self.bombs)
+
+    def allocate(self, bomb: _Bomb) -> int:
+        """
+        Allocate a free slot for a bomb and grow the arrays if all slots are in use
+        :return: The slot
+        """
+        free_slots = np.flatnonzero(~self.active)
+        if len(free_slots) == 0:
+            self._grow()
+            free_slots = np.flatnonzero(~self.active)
+
+        slot = free_slots[0]
+        self.active[slot] = True
+        self.moved[slot] = False
+        self.moving_directions[slot] = 0
+        self.directions[slot] = 0
+        self.lost[slot] = False
+        self.bombs[slot] = bomb
+        return slot
+
+    def _grow(self):
+        capacity = len(self.active)
+        if self.fixed:
+            raise RuntimeError('The bomb capacity {} of the shared arrays is exceeded'.format(capacity))
+        for name in ['active', 'positions', 'life', 'blast_strength', 'bomber_ids', 'moved', 'moving_directions',
+                     'directions', 'lost']:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.bombs.extend([None] * capacity)
+
+
 class _Bomb(object):
-    __slots__ = ['bomber', 'pos', 'has_been_moved', 'blast_strength', 'life', 'first_moving_direction']
+    __slots__ = ['_store', '_slot']
 
     def __init__(self, bomber: _Agent, pos: _Pos, blast_strength: BlastStrengthType,
-                 life: BombLifeType, has_been_moved=False, first_moving_direction=None) -> None:
+                 life: BombLifeType, has_been_moved=False, first_moving_direction=None,
+                 store: _BombStore = None) -> None:
+        if store is None:
+            store = _BombStore(1, {})
+        self._store = store
+        self._slot = store.allocate(self)
+
         self.bomber = bomber
         self.pos = pos
         self.has_been_moved = has_been_moved
         self.blast_strength = blast_strength
         self.life = life
-        self.first_moving_direction: ActionType = first_moving_direction
+        self.first_moving_direction = first_moving_direction
+
+    @classmethod
+    def view(cls, store: _BombStore, slot: int) -> _Bomb:
+        """View an active slot whose attributes are set elsewhere, e.g., by a teammate sharing the store"""
+        bomb = cls.__new__(cls)
+        bomb._store = store
+        bomb._slot = slot
+        store.bombs[slot] = bomb
+        return bomb
+
+    @property
+    def bomber(self) -> _Agent:
+        return self._store.id_to_agent[int(self._store.bomber_ids[self._slot])]
+
+    @bomber.setter
+    def bomber(self, bomber: _Agent):
+        self._store.id_to_agent.setdefault(bomber.id, bomber)
+        self._store.bomber_ids[self._slot] = bomber.id
+
+    @property
+    def pos(self) -> _Pos:
+        row, col = self._store.positions[self._slot]
+        return _Pos((int(row), int(col)))
+
+    @pos.setter
+    def pos(self, pos: _Pos):
+        self._store.positions[self._slot] = pos
+
+    @property
+    def has_been_moved(self) -> bool:
+        return bool(self._store.moved[self._slot])
+
+    @has_been_moved.setter
+    def has_been_moved(self, has_been_moved: bool):
+        self._store.moved[self._slot] = has_been_moved
+
+    @property
+    def blast_strength(self) -> BlastStrengthType:
+        return float(self._store.blast_strength[self._slot])
+
+    @blast_strength.setter
+    def blast_strength(self, blast_strength: BlastStrengthType):
+        self._store.blast_strength[self._slot] = blast_strength
+
+    @property
+    def life(self) -> BombLifeType:
+        return float(self._store.life[self._slot])
+
+    @life.setter
+    def life(self, life: BombLifeType):
+        self._store.life[self._slot] = life
+
+    @property
+    def first_moving_direction(self) -> ActionType:
+        direction = self._store.moving_directions[self._slot]
+        if direction == 0:
+            return None
+        return ActionType(int(direction))
+
+    @first_moving_direction.setter
+    def first_moving_direction(self, direction: ActionType):
+        self._store.moving_directions[self._slot] = 0 if direction is None else direction.value
+
+    @property
+    def moving_direction(self) -> ActionType:
+        """The direction a bomb is moving in at the current step, which is None if it does not move"""
+        direction = self._store.directions[self._slot]
+        if direction == 0:
+            return None
+        return ActionType(int(direction))
+
+    @property
+    def is_lost(self) -> bool:
+        """Whether a moving bomb cannot be followed, after which its position and life may be INACCURATE"""
+        return bool(self._store.lost[self._slot])
 
     def __hash__(self):
         return hash(str(self.bomber.id) + str(self.pos))
@@ -0,0 +1,244 @@
+from typing import Dict, List, Tuple
+from multiprocessing import shared_memory
+from pommerman.constants import BOARD_SIZE, NUM_AGENTS
+from env_related import *
+
+import numpy as np
+
+# Attributes of _AgentStore and _BombStore kept in a TeamState
+_agent_store_fields = ['ids', 'values', 'positions', 'ammo', 'blast_strength', 'can_kick', 'is_alive']
+_bomb_store_fields = ['active', 'positions', 'life', 'blast_strength', 'bomber_ids', 'moved', 'moving_directions',
+                      'directions', 'lost']
+
+# Values of cells which do not change by themselves in one step
+_static_cell_table = np.zeros(256, dtype=bool)
+_static_cell_table[[passage_value, rigid_value, wood_value, add_bomb_value, increase_range_value,
+                    enable_kick_value]] = True
+
+# The step of a member which has not observed the current game, which is never the step before another one
+_no_step = -2
+
+
+def _team_fields(board_size: int, num_agents: int, bomb_capacity: int) -> List[Tuple[str, type, Tuple[int, ...]]]:
+    """
+    :return: The name, the dtype and the shape of each array of a TeamState
+    """
+    planes = (board_size, board_size)
+    return [
+        # The step whose tracking is published, which is -1 before the first step of a game
+        ('tracked_step', np.int64, (1,)),
+
+        # The step and the observed planes of the last observation of each member
+        ('member_steps', np.int64, (2,)),
+        ('member_board', np.uint8, (2,) + planes),
+        ('member_bomb_life', np.float64, (2,) + planes),
+        ('member_bomb_blast_strength', np.float64, (2,) + planes),
+        # Positions of the agents seen by each member at its last observation, which are -1 for the other agents
+        ('member_agent_positions', np.int64, (2, num_agents, 2)),
+
+        # The merged planes and the item board of the tracked step
+        ('merged_board', np.uint8, planes),
+        ('merged_bomb_life', np.float64, planes),
+        ('merged_bomb_blast_strength', np.float64, planes),
+        ('item_board', np.uint8, planes),
+
+        ('agent_ids', np.int64, (num_agents,)),
+        ('agent_values', np.int64, (num_agents,)),
+        ('agent_positions', np.int64, (num_agents, 2)),
+        ('agent_ammo', np.int64, (num_agents,)),
+        ('agent_blast_strength', np.float64, (num_agents,)),
+        ('agent_can_kick', bool, (num_agents,)),
+        ('agent_is_alive', bool, (num_agents,)),
+        # Agents which die at the tracked step
+        ('agent_died', bool, (num_agents,)),
+
+        ('bomb_active', bool, (bomb_capacity,)),
+        ('bomb_positions', np.int64, (bomb_capacity, 2)),
+        ('bomb_life', np.float64, (bomb_capacity,)),
+        ('bomb_blast_strength', np.float64, (bomb_capacity,)),
+        ('bomb_bomber_ids', np.int64, (bomb_capacity,)),
+        ('bomb_moved', bool, (bomb_capacity,)),
+        ('bomb_moving_directions', np.int64, (bomb_capacity,)),
+        ('bomb_directions', np.int64, (bomb_capacity,)),
+        ('bomb_lost', bool, (bomb_capacity,)),
+        # Bombs which are laid or kicked at the tracked step
+        ('bomb_new', bool, (bomb_capacity,)),
+        ('bomb_new_moving', bool, (bomb_capacity,)),
+    ]
+
+
+class TeamState(object):
+    """
+    The tracking state shared by the SimAgents of a team, kept in a block of shared memory, so teammates in different
+    processes share it as well as the ones in the same process.
+
+    In each step, the teammate which acts first is the leader: it merges its observation with the last one of its
+    teammate where it sees fog, locates agents seen by either of them, tracks items, bombs and agents on the merged
+    planes and publishes the result. The other teammate fills its fog with the merged planes and takes the published
+    result instead of tracking again. Teammates must not act at the same time, which holds for the agents of an
+    environment since they act in turns.
+
+    A TeamState passed to another process, e.g., as an argument of multiprocessing, attaches to the same memory.
+    """
+
+    def __init__(self,
+                 board_size: int = BOARD_SIZE,
+                 num_agents: int = NUM_AGENTS,
+                 bomb_capacity: int = 2 * initial_bomb_capacity,
+                 name: str = None):
+        """
+        :param board_size: The size of boards
+        :param num_agents: The number of agents of a game
+        :param bomb_capacity: The maximum number of bombs tracked at the same time
+        :param name: The name of the shared memory of an existing TeamState to attach to. A new block of shared
+        memory is created if it is None.
+        """
+        self.board_size = board_size
+        self.num_agents = num_agents
+        self.bomb_capacity = bomb_capacity
+
+        fields = _team_fields(board_size, num_agents, bomb_capacity)
+        offsets = []
+        size = 0
+        for _, dtype, shape in fields:
+            offsets.append(size)
+            # Arrays are aligned to 8 bytes
+            num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            size += -(-num_bytes // 8) * 8
+
+        self._owner = name is None
+        self._memory = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+        self.arrays: Dict[str, np.ndarray] = {
+            field: np.ndarray(shape, dtype=dtype, buffer=self._memory.buf, offset=offset)
+            for (field, dtype, shape), offset in zip(fields, offsets)
+        }
+        if self._owner:
+            self.reset()
+
+    def __reduce__(self):
+        return TeamState, (self.board_size, self.num_agents, self.bomb_capacity, self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    @property
+    def tracked_step(self) -> int:
+        return int(self.arrays['tracked_step'][0])
+
+    @tracked_step.setter
+    def tracked_step(self, step: int):
+        self.arrays['tracked_step'][0] = step
+
+    def reset(self) -> None:
+        """Start a new game"""
+        self.tracked_step = -1
+        self.arrays['member_steps'].fill(_no_step)
+
+    def agent_store_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        :return: The arrays backing the attributes of _AgentStore
+        """
+        return self._store_arrays('agent', _agent_store_fields)
+
+    def bomb_store_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        :return: The arrays backing the attributes of _BombStore
+        """
+        return self._store_arrays('bomb', _bomb_store_fields)
+
+    def _store_arrays(self, prefix: str, fields: List[str]) -> Dict[str, np.ndarray]:
+        return {field: self.arrays['{}_{}'.format(prefix, field)] for field in fields}
+
+    def publish_observation(self, member: int, step: int, board: np.ndarray, bomb_life: np.ndarray,
+                            bomb_blast_strength: np.ndarray) -> None:
+        """Keep the observed planes of a member, which are used by its teammate when it leads the next step"""
+        self.arrays['member_steps'][member] = step
+        np.copyto(self.arrays['member_board'][member], board)
+        np.copyto(self.arrays['member_bomb_life'][member], bomb_life)
+        np.copyto(self.arrays['member_bomb_blast_strength'][member], bomb_blast_strength)
+
+    def publish_agent_positions(self, member: int, agent_positions: Dict[int, Tuple[int, int]]) -> None:
+        """
+        Keep the positions of the agents seen by a member, which are used by its teammate when it leads the next step
+        :param member: The index of the member
+        :param agent_positions: Positions keyed by agent values
+        """
+        positions = self.arrays['member_agent_positions'][member]
+        positions.fill(-1)
+        for agent_value, position in agent_positions.items():
+            positions[agent_value_to_id(agent_value)] = position
+
+    def teammate_agent_positions(self, member: int, step: int) -> Dict[int, Tuple[int, int]]:
+        """
+        :return: Positions of the agents seen by the teammate of a member in the step before, keyed by agent values,
+        which is empty if the teammate has not observed that step
+        """
+        teammate = 1 - member
+        if self.arrays['member_steps'][teammate] != step - 1:
+            return {}
+        return {agent_id_to_value(agent_id): (row, col)
+                for agent_id, (row, col) in enumerate(self.arrays['member_agent_positions'][teammate].tolist())
+                if row >= 0}
+
+    def merge_as_leader(self, member: int, step: int, board: np.ndarray, bomb_life: np.ndarray,
+                        bomb_blast_strength: np.ndarray) -> None:
+        """
+        Fill the fog of the planes of the leader in place with the last observation of its teammate, and publish the
+        merged planes
+        """
+        teammate = 1 - member
+        if self.arrays['member_steps'][teammate] == step - 1:
+            fill_fog_with_last_step(board, bomb_life, bomb_blast_strength,
+                                    self.arrays['member_board'][teammate],
+                                    self.arrays['member_bomb_life'][teammate],
+                                    self.arrays['member_bomb_blast_strength'][teammate])
+        np.copyto(self.arrays['merged_board'], board)
+        np.copyto(self.arrays['merged_bomb_life'], bomb_life)
+        np.copyto(self.arrays['merged_bomb_blast_strength'], bomb_blast_strength)
+
+    def merge_as_follower(self, board: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray) -> None:
+        """Fill the fog of the planes of the follower in place with the merged planes of the leader"""
+        fill_fog(board, bomb_life, bomb_blast_strength,
+                 self.arrays['merged_board'], self.arrays['merged_bomb_life'],
+                 self.arrays['merged_bomb_blast_strength'])
+
+    def close(self) -> None:
+        """Detach from the shared memory, which is freed as well if this TeamState has created it"""
+        self.arrays = {}
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+def fill_fog(board: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray,
+             source_board: np.ndarray, source_bomb_life: np.ndarray, source_bomb_blast_strength: np.ndarray) -> None:
+    """Fill the fog of planes in place with planes of the same step"""
+    fog = board == fog_value
+    np.copyto(board, source_board, where=fog)
+    np.copyto(bomb_life, source_bomb_life, where=fog)
+    np.copyto(bomb_blast_strength, source_bomb_blast_strength, where=fog)
+
+
+def fill_fog_with_last_step(board: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray,
+                            last_board: np.ndarray, last_bomb_life: np.ndarray,
+                            last_bomb_blast_strength: np.ndarray) -> None:
+    """
+    Fill the fog of planes in place with planes of the last step. Only cells which do not change by themselves in a
+    step are taken, i.e., walls, wood, passages and items, and bombs which do not explode in this step, whose life is
+    reduced by a step. Cells with agents or flames stay in fog.
+    """
+    fog = board == fog_value
+    has_bomb = fog & (last_bomb_life > bomb_life_reduction)
+    is_static = fog & ~has_bomb & _static_cell_table[last_board]
+
+    np.copyto(board, last_board, where=is_static)
+    board[has_bomb] = bomb_value
+    np.subtract(last_bomb_life, bomb_life_reduction, out=bomb_life, where=has_bomb)
+    np.copyto(bomb_blast_strength, last_bomb_blast_strength, where=has_bomb)
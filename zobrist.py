@@ -0,0 +1,230 @@
+from typing import Tuple
+from collections import OrderedDict
+from pommerman.constants import BOARD_SIZE, NUM_AGENTS
+from env_related import *
+
+import numpy as np
+
+# Values beyond these bounds share the entries of the bounds
+_max_cell_value = 16
+_max_bomb_life = 16
+_max_blast_strength = 32
+_max_ammo = 16
+_max_flame_life = 4
+_num_directions = len(ActionType)
+
+# Flames which are loaded into simulated environments have this life
+_new_flame_life = 2
+
+
+class ZobristHasher(object):
+    """
+    Zobrist hashing of simulated states: a state is hashed to the XOR of random 64-bit keys of its parts, so a change
+    of a part is applied by XOR-ing its old and new keys.
+
+    The parts are the cells, each with its board value, bomb life, bomb blast strength, flame life and bomb moving
+    direction, and the alive agents, each with its position, ammo, blast strength and kick ability. The number of
+    steps is not a part, so the same state reached at different depths has the same hash.
+    """
+
+    def __init__(self, board_size: int = BOARD_SIZE, num_agents: int = NUM_AGENTS, seed: int = 0):
+        rng = np.random.default_rng(seed)
+
+        def keys(*shape, zero_first=False):
+            _keys = rng.integers(1, 1 << 63, size=shape, dtype=np.int64).view(np.uint64)
+            if zero_first:
+                # The empty value of a part has no key, e.g., a cell without a bomb
+                _keys[..., 0] = 0
+            return _keys
+
+        self.board_size = board_size
+        self._cell_keys = keys(board_size, board_size, _max_cell_value)
+        self._bomb_life_keys = keys(board_size, board_size, _max_bomb_life, zero_first=True)
+        self._bomb_blast_strength_keys = keys(board_size, board_size, _max_blast_strength, zero_first=True)
+        self._flame_life_keys = keys(board_size, board_size, _max_flame_life, zero_first=True)
+        self._moving_direction_keys = keys(board_size, board_size, _num_directions, zero_first=True)
+
+        self._agent_position_keys = keys(num_agents, board_size, board_size)
+        self._agent_ammo_keys = keys(num_agents, _max_ammo)
+        self._agent_blast_strength_keys = keys(num_agents, _max_blast_strength)
+        self._agent_can_kick_keys = keys(num_agents, 2)
+
+    def hash_cells(self, rows: np.ndarray, cols: np.ndarray, board: np.ndarray, bomb_life: np.ndarray,
+                   bomb_blast_strength: np.ndarray, flame_life: np.ndarray = None,
+                   moving_direction: np.ndarray = None) -> int:
+        """
+        Hash some cells of the planes of a state
+        :param rows: Rows of the cells
+        :param cols: Columns of the cells
+        :param board: The board
+        :param bomb_life: The bomb life plane
+        :param bomb_blast_strength: The bomb blast strength plane
+        :param flame_life: The life of flames, which is taken as the life of new flames where the board has flames
+        if it is None
+        :param moving_direction: Values of the moving directions of bombs, which are 0 for bombs which do not move.
+        It is taken as all 0 if it is None.
+        :return: The XOR of the keys of the cells
+        """
+        values = board[rows, cols].astype(np.int64)
+        life = np.minimum(bomb_life[rows, cols].astype(np.int64), _max_bomb_life - 1)
+        blast_strength = np.minimum(bomb_blast_strength[rows, cols].astype(np.int64), _max_blast_strength - 1)
+        cell_keys = self._cell_keys[rows, cols, np.minimum(values, _max_cell_value - 1)] ^ \
+            self._bomb_life_keys[rows, cols, life] ^ self._bomb_blast_strength_keys[rows, cols, blast_strength]
+
+        if flame_life is None:
+            cell_keys ^= self._flame_life_keys[rows, cols, np.where(values == flame_value, _new_flame_life, 0)]
+        else:
+            cell_keys ^= self._flame_life_keys[rows, cols, np.minimum(flame_life[rows, cols].astype(np.int64),
+                                                                      _max_flame_life - 1)]
+        if moving_direction is not None:
+            cell_keys ^= self._moving_direction_keys[rows, cols, moving_direction[rows, cols]]
+
+        return int(np.bitwise_xor.reduce(cell_keys)) if len(cell_keys) != 0 else 0
+
+    def hash_planes(self, board: np.ndarray, bomb_life: np.ndarray, bomb_blast_strength: np.ndarray,
+                    flame_life: np.ndarray = None, moving_direction: np.ndarray = None) -> int:
+        """
+        Hash all cells of the planes of a state, see hash_cells()
+        """
+        rows, cols = np.indices(board.shape).reshape(2, -1)
+        return self.hash_cells(rows, cols, board, bomb_life, bomb_blast_strength, flame_life, moving_direction)
+
+    def update_planes(self, planes_hash: int, old_planes: Tuple[np.ndarray, ...], new_planes: Tuple[np.ndarray, ...]
+                      ) -> int:
+        """
+        Update the hash of planes with the cells which change
+        :param planes_hash: The hash of the old planes
+        :param old_planes: The old board, bomb life and bomb blast strength
+        :param new_planes: The new board, bomb life and bomb blast strength
+        :return: The hash of the new planes
+        """
+        changed = np.zeros(old_planes[0].shape, dtype=bool)
+        for old_plane, new_plane in zip(old_planes, new_planes):
+            changed |= old_plane != new_plane
+        rows, cols = np.nonzero(changed)
+        return planes_hash ^ self.hash_cells(rows, cols, *old_planes) ^ self.hash_cells(rows, cols, *new_planes)
+
+    def hash_moving_bombs(self, positions: np.ndarray, directions: np.ndarray) -> int:
+        """
+        Hash the moving directions of bombs, which are the parts of the cells not covered by hash_planes() when its
+        moving_direction is None
+        :param positions: Positions of the bombs of shape (K, 2)
+        :param directions: Values of the moving directions of the bombs
+        :return: The XOR of the keys of the directions
+        """
+        if len(directions) == 0:
+            return 0
+        return int(np.bitwise_xor.reduce(self._moving_direction_keys[positions[:, 0], positions[:, 1], directions]))
+
+    def hash_agents(self, agent_ids: np.ndarray, positions: np.ndarray, ammo: np.ndarray,
+                    blast_strength: np.ndarray, can_kick: np.ndarray) -> int:
+        """
+        Hash alive agents
+        :param agent_ids: Ids of the agents
+        :param positions: Positions of the agents of shape (K, 2)
+        :param ammo: Ammo of the agents
+        :param blast_strength: Blast strength of the agents
+        :param can_kick: Kick abilities of the agents
+        :return: The XOR of the keys of the agents
+        """
+        if len(agent_ids) == 0:
+            return 0
+        agent_keys = self._agent_position_keys[agent_ids, positions[:, 0], positions[:, 1]] ^ \
+            self._agent_ammo_keys[agent_ids, np.clip(ammo, 0, _max_ammo - 1).astype(np.int64)] ^ \
+            self._agent_blast_strength_keys[agent_ids, np.clip(blast_strength, 0,
+                                                               _max_blast_strength - 1).astype(np.int64)] ^ \
+            self._agent_can_kick_keys[agent_ids, can_kick.astype(np.int64)]
+        return int(np.bitwise_xor.reduce(agent_keys))
+
+    def hash_env(self, env) -> int:
+        """
+        Hash the state of a Pommerman environment, which is the same as the hash of SimAgent._state_hash when the
+        environment is synchronized with SimAgent
+        """
+        board = env._board
+        bomb_life = np.zeros(board.shape, dtype=np.int64)
+        bomb_blast_strength = np.zeros(board.shape, dtype=np.int64)
+        moving_direction = np.zeros(board.shape, dtype=np.int64)
+        for bomb in env._bombs:
+            bomb_life[bomb.position] = bomb.life
+            bomb_blast_strength[bomb.position] = bomb.blast_strength
+            if bomb.moving_direction is not None:
+                moving_direction[bomb.position] = bomb.moving_direction.value
+        flame_life = np.zeros(board.shape, dtype=np.int64)
+        for flame in env._flames:
+            flame_life[flame.position] = flame.life
+
+        agents = [agent for agent in env._agents if agent.is_alive]
+        return self.hash_planes(board, bomb_life, bomb_blast_strength, flame_life, moving_direction) ^ \
+            self.hash_agents(np.array([agent.agent_id for agent in agents], dtype=np.int64),
+                             np.array([agent.position for agent in agents], dtype=np.int64).reshape(-1, 2),
+                             np.array([agent.ammo for agent in agents]),
+                             np.array([agent.blast_strength for agent in agents]),
+                             np.array([agent.can_kick for agent in agents], dtype=bool))
+
+
+# Shared by all SimAgents, so the hashes of their states can be compared
+default_hasher = ZobristHasher()
+
+
+class TranspositionTable(object):
+    """
+    A bounded table of values of searched states keyed by their hashes, with one of the eviction policies:
+
+    * 'lru': The least recently used entry is evicted when the table is full
+    * 'depth': Each hash has one slot of a fixed array, and an entry only replaces the one in its slot when its
+      search depth is not smaller, so the results of deeper searches are kept
+    """
+
+    def __init__(self, capacity: int = 1 << 16, policy: str = 'lru'):
+        if policy not in ['lru', 'depth']:
+            raise ValueError('Unknown eviction policy {}'.format(policy))
+        self.capacity = capacity
+        self.policy = policy
+
+        self._entries = OrderedDict()
+        # Each slot holds the hash, the depth and the value of an entry
+        self._slots = [None] * capacity if policy == 'depth' else None
+
+    def __len__(self):
+        if self.policy == 'lru':
+            return len(self._entries)
+        return sum(slot is not None for slot in self._slots)
+
+    def get(self, state_hash: int, default=None):
+        """
+        :return: The value of a state, or the default if it is not in the table
+        """
+        if self.policy == 'lru':
+            value = self._entries.get(state_hash, default)
+            if state_hash in self._entries:
+                self._entries.move_to_end(state_hash)
+            return value
+
+        slot = self._slots[state_hash % self.capacity]
+        if slot is None or slot[0] != state_hash:
+            return default
+        return slot[2]
+
+    def put(self, state_hash: int, value, depth: int = 0) -> None:
+        """
+        :param state_hash: The hash of a state
+        :param value: The value of the state
+        :param depth: The depth of the search which gives the value, used by the 'depth' policy
+        """
+        if self.policy == 'lru':
+            self._entries[state_hash] = value
+            self._entries.move_to_end(state_hash)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            return
+
+        index = state_hash % self.capacity
+        slot = self._slots[index]
+        if slot is None or slot[0] == state_hash or depth >= slot[1]:
+            self._slots[index] = (state_hash, depth, value)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        if self._slots is not None:
+            self._slots = [None] * self.capacity